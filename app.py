@@ -1,9 +1,36 @@
 import os
 import time
+import hashlib
+import secrets
+import sqlite3
+import threading
+import gzip
+import json
+import shutil
+import re
+import socket
+import atexit
+import io
+import zlib
+import codecs
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
 from datetime import datetime
-from flask import Flask, Response, render_template, request, send_file, session, flash
-from rdflib import Graph, Literal, Namespace, URIRef, RDF, BNode
-import requests
+from urllib.parse import quote
+from flask import Flask, Response, render_template, request, send_file, session, redirect, url_for, jsonify
+import click
+from rdflib import Graph, Dataset, Literal, Namespace, URIRef, RDF, BNode, Variable
+from rdflib.paths import Path
+from rdflib import plugin
+from rdflib.parser import Parser
+from rdflib.serializer import Serializer
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from rdflib.util import guess_format
 import logging
 import random
@@ -11,13 +38,978 @@ import string
 import csv
 app = Flask(__name__)
 
-# Set the secret key for sessions
-app.secret_key = b'_5#y2L"F4Q8z\n\xec]/'
+# Set the secret key for sessions. Every worker process and node has to use
+# the same key, so production sets SECRET_KEY.
+app.secret_key = os.getenv('SECRET_KEY', '').encode('utf-8') or b'_5#y2L"F4Q8z\n\xec]/'
 
-# Set the upload folder path
+# Set the upload folder path, it's created by warm_up() or the first upload
 app.config['UPLOAD_FOLDER'] = 'upload'
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+
+# Imports that only some requests need (requests for the GraphDB proxy, the
+# process pool for jobs and batches, tarfile/zipfile for archives) are done
+# where they're used, so a cold start doesn't pay for them
+
+# Log a JSON line for every timed pipeline stage, in addition to /metrics
+app.config['STRUCTURED_LOGS'] = os.getenv('STRUCTURED_LOGS', '0') == '1'
+
+# Metrics exposed on /metrics as name -> (type, help, histogram buckets)
+METRICS = {
+    'metamap_stage_seconds': ('histogram', 'Time spent in each stage of the upload/submit pipeline',
+                              (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)),
+    'metamap_upload_bytes_per_second': ('histogram', 'Rate at which uploads are written to disk',
+                                        (2 ** 16, 2 ** 18, 2 ** 20, 2 ** 22, 2 ** 24, 2 ** 26, 2 ** 28)),
+    'metamap_upload_bytes_total': ('counter', 'Bytes of uploaded mapping files', None),
+    'metamap_triples_parsed_total': ('counter', 'Triples parsed from uploaded mapping files', None),
+    'metamap_output_bytes_total': ('counter', 'Bytes of generated metadata files', None),
+    'metamap_export_quads_total': ('counter', 'Quads written by /export and flask export', None),
+}
+
+# name -> {sorted label items: value}, where a histogram value is [bucket counts, sum, count]
+metric_values = {name: {} for name in METRICS}
+metrics_lock = threading.Lock()
+metrics_logger = logging.getLogger('metamap.metrics')
+
+# How often each worker process publishes its metrics to the database, where
+# /metrics on any worker adds them all up
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+# Snapshots not updated for this many seconds belong to processes that have
+# exited, and are dropped
+app.config['METRICS_SNAPSHOT_TTL'] = float(os.getenv('METRICS_SNAPSHOT_TTL', 24 * 60 * 60))
+metrics_flushed_at = 0.0
+# (pid, key of this process's row in metric_snapshots)
+metrics_worker = None
+
+
+def observe(name, value, **labels):
+    metric_type, _, buckets = METRICS[name]
+    key = tuple(sorted(labels.items()))
+    with metrics_lock:
+        series = metric_values[name]
+        if metric_type == 'counter':
+            series[key] = series.get(key, 0) + value
+            return
+        histogram = series.setdefault(key, [[0] * len(buckets), 0.0, 0])
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+@contextmanager
+def timed_stage(stage, **labels):
+    # Record how long the block takes under metamap_stage_seconds{stage=...}
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe('metamap_stage_seconds', seconds, stage=stage, **labels)
+        if app.config['STRUCTURED_LOGS']:
+            metrics_logger.info(json.dumps({'event': 'stage', 'stage': stage, 'seconds': round(seconds, 6), **labels}))
+
+
+def flush_metrics(force=False):
+    global metrics_flushed_at
+    now = time.time()
+    if not force and now - metrics_flushed_at < app.config['METRICS_FLUSH_INTERVAL']:
+        return
+    metrics_flushed_at = now
+    with metrics_lock:
+        snapshot = json.dumps([[name, key, value] for name, series in metric_values.items()
+                               for key, value in series.items()])
+    with connect_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO metric_snapshots (worker, snapshot, updated) VALUES (?, ?, ?)",
+                     (metrics_worker_key(), snapshot, now))
+    conn.close()
+
+
+def metrics_worker_key():
+    # Pids are reused, so a new process could take over the row of one that
+    # exited; the key is random and made again in a process forked from this one
+    global metrics_worker
+    if metrics_worker is None or metrics_worker[0] != os.getpid():
+        metrics_worker = (os.getpid(), f"{socket.gethostname()}:{os.getpid()}:{int(time.time())}:{uuid.uuid4().hex}")
+    return metrics_worker[1]
+
+
+def reset_metrics():
+    # Initializer of job pool processes: a process that was forked, or whose
+    # imports recorded anything, mustn't publish what isn't its own
+    global metrics_flushed_at
+    with metrics_lock:
+        for series in metric_values.values():
+            series.clear()
+    metrics_flushed_at = 0.0
+
+
+@app.after_request
+def publish_metrics(response):
+    flush_metrics()
+    return response
+
+
+def collect_metrics():
+    # Sum the latest snapshot of every worker process
+    flush_metrics(force=True)
+    conn = connect_db()
+    with conn:
+        conn.execute("DELETE FROM metric_snapshots WHERE updated < ?",
+                     (time.time() - app.config['METRICS_SNAPSHOT_TTL'],))
+    snapshots = [row['snapshot'] for row in conn.execute("SELECT snapshot FROM metric_snapshots")]
+    conn.close()
+
+    totals = {name: {} for name in METRICS}
+    for snapshot in snapshots:
+        for name, key, value in json.loads(snapshot):
+            if name not in METRICS:
+                continue
+            metric_type, _, buckets = METRICS[name]
+            key = tuple(tuple(item) for item in key)
+            series = totals[name]
+            if metric_type == 'counter':
+                series[key] = series.get(key, 0) + value
+                continue
+            histogram = series.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], value[0], strict=True)]
+            histogram[1] += value[1]
+            histogram[2] += value[2]
+    return totals
+
+
+def label_value(value):
+    # Escape a label value as the exposition format requires
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics(values):
+    # Prometheus text exposition format
+    def label_text(key, extra=()):
+        items = list(key) + list(extra)
+        if not items:
+            return ''
+        return '{' + ','.join(f'{name}="{label_value(value)}"' for name, value in items) + '}'
+
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for key, value in values[name].items():
+            if metric_type == 'counter':
+                lines.append(f"{name}{label_text(key)} {value}")
+                continue
+            bucket_counts, total, count = value
+            for bound, bucket_count in zip(buckets, bucket_counts, strict=True):
+                lines.append(f"{name}_bucket{label_text(key, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{label_text(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{label_text(key)} {total}")
+            lines.append(f"{name}_count{label_text(key)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(collect_metrics()), mimetype='text/plain; version=0.0.4')
+
+
+# Upper bound on the number of triples kept in the parsed graph cache
+app.config['GRAPH_CACHE_MAX_TRIPLES'] = int(os.getenv('GRAPH_CACHE_MAX_TRIPLES', 2000000))
+
+# Parsed mapping graphs shared between /upload and /submit_metadata, keyed by
+# (content hash, rdf format) and kept in least-recently-used order
+graph_cache = OrderedDict()
+graph_cache_lock = threading.Lock()
+
+
+def file_content_hash(file_path):
+    # Hash the file in chunks so large mappings are never fully loaded
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# Line-based uploads (N-Triples, N-Quads) at least this large are split on
+# line boundaries and parsed by PARSE_WORKERS processes
+app.config['PARALLEL_PARSE_MIN_BYTES'] = int(os.getenv('PARALLEL_PARSE_MIN_BYTES', 32 * 1024 * 1024))
+app.config['PARSE_WORKERS'] = int(os.getenv('PARSE_WORKERS', os.cpu_count() or 1))
+LINE_BASED_FORMATS = ('nt', 'nquads')
+PARSE_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Copy Turtle/N-Triples uploads into the RDF-star output as they are, only
+# streaming them for the subjects to annotate, instead of parsing them into a
+# graph and serializing it again
+app.config['SCAN_MAPPING_SUBJECTS'] = os.getenv('SCAN_MAPPING_SUBJECTS', '1') == '1'
+SCANNABLE_FORMATS = {'turtle': 'text/turtle', 'nt': 'application/n-triples'}
+
+
+def mapping_rdf_format(file_name):
+    # rdflib parser name for a mapping file, Turtle unless the extension says otherwise
+    return guess_format(file_name) or 'turtle'
+
+
+def load_mapping_graph(file_path, rdf_format='turtle', content_hash=None):
+    # Return the parsed graph for file_path, only parsing it on a cache miss.
+    # The graph is shared between requests so callers must not modify it.
+    if content_hash is None:
+        content_hash = file_content_hash(file_path)
+    key = (content_hash, rdf_format)
+
+    with graph_cache_lock:
+        entry = graph_cache.get(key)
+        if entry is not None:
+            graph_cache.move_to_end(key)
+            logging.debug(f"Graph cache hit for {file_path}")
+            return entry[0]
+
+    g = Graph()
+    with timed_stage('parse', format=rdf_format):
+        if rdf_format in LINE_BASED_FORMATS:
+            parse_line_based(g, file_path, rdf_format, content_hash)
+        else:
+            g.parse(file_path, format=rdf_format, publicID=None)
+    observe('metamap_triples_parsed_total', len(g), format=rdf_format)
+    cache_mapping_graph(key, g)
+    return g
+
+
+def parse_line_based(g, file_path, rdf_format, content_hash):
+    # Every line of N-Triples/N-Quads is a statement, so the file can be cut at
+    # any newline and the pieces parsed independently. Quads are merged into g
+    # as plain triples, like the graph a Turtle upload produces.
+    size = os.path.getsize(file_path)
+    workers = app.config['PARSE_WORKERS']
+    if rdf_format == 'nt' and (workers < 2 or size < app.config['PARALLEL_PARSE_MIN_BYTES']):
+        g.parse(file_path, format=rdf_format, publicID=None)
+        return
+
+    # Blank node labels are document-wide, so every chunk must map them alike
+    bnode_prefix = f"n{content_hash[:16]}"
+    chunk_size = max(1024 * 1024, min(PARSE_CHUNK_SIZE, size // (workers * 4) + 1))
+    starts, ends = zip(*line_ranges(file_path, chunk_size), strict=True) if size else ((), ())
+
+    if workers < 2 or size < app.config['PARALLEL_PARSE_MIN_BYTES']:
+        chunks = map(parse_line_range, repeat(file_path), repeat(rdf_format), starts, ends, repeat(bnode_prefix))
+        for triples in chunks:
+            g.addN((s, p, o, g) for s, p, o in triples)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = executor.map(parse_line_range, repeat(file_path), repeat(rdf_format), starts, ends,
+                              repeat(bnode_prefix))
+        for triples in chunks:
+            g.addN((s, p, o, g) for s, p, o in triples)
+
+
+def line_ranges(file_path, chunk_size):
+    # (start, end) byte offsets of roughly chunk_size bytes, each ending after a newline
+    size = os.path.getsize(file_path)
+    ranges = []
+    with open(file_path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(start + chunk_size)
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+class LabelledBNodes(dict):
+    # bnode_context for rdflib's N-Triples/N-Quads parsers that names each blank
+    # node after its label instead of a fresh id, so chunks agree on them
+    def __init__(self, prefix):
+        super().__init__()
+        self.prefix = prefix
+
+    def get(self, label, default=None):  # noqa: ARG002 - keeps dict.get's signature
+        return f"{self.prefix}{label}"
+
+
+def parse_line_range(file_path, rdf_format, start, end, bnode_prefix):
+    # Runs in a parse worker: parse one line-aligned slice of the file
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    chunk = Dataset(default_union=True) if rdf_format == 'nquads' else Graph()
+    chunk.parse(data=data, format=rdf_format, bnode_context=LabelledBNodes(bnode_prefix))
+    return list(chunk.triples((None, None, None)))
+
+
+def cache_mapping_graph(key, g):
+    size = len(g)
+    max_triples = app.config['GRAPH_CACHE_MAX_TRIPLES']
+    if size > max_triples:
+        # Too big to ever fit, don't flush the whole cache for it
+        return
+
+    with graph_cache_lock:
+        graph_cache[key] = (g, size)
+        graph_cache.move_to_end(key)
+        total = sum(cached_size for _, cached_size in graph_cache.values())
+        while total > max_triples:
+            _, (_, evicted_size) = graph_cache.popitem(last=False)
+            total -= evicted_size
+
+
+# Largest request body accepted by /upload, larger uploads get a 413
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 1024 * 1024 * 1024))
+
+# Number of lines, and of bytes, of the uploaded file shown back in Ack.html
+app.config['UPLOAD_PREVIEW_LINES'] = int(os.getenv('UPLOAD_PREVIEW_LINES', 200))
+app.config['UPLOAD_PREVIEW_BYTES'] = int(os.getenv('UPLOAD_PREVIEW_BYTES', 64 * 1024))
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_SNIFF_SIZE = 4096
+
+# Formats generated metadata can be written in, with file extension and media type.
+# Any of them can also be gzip compressed.
+OUTPUT_FORMATS = {
+    'turtle': ('.ttl', 'text/turtle'),
+    'nt': ('.nt', 'application/n-triples'),
+    'nq': ('.nq', 'application/n-quads'),
+    'trig': ('.trig', 'application/trig'),
+}
+
+# Encodings /view_metadata and /download_metadata can send precompressed copies
+# in, by preference. Brotli is only used when the brotli package is installed.
+# Each maps to (extension, function wrapping a binary file in a compressing writer).
+PRECOMPRESSED_ENCODINGS = {}
+if brotli is not None:
+    PRECOMPRESSED_ENCODINGS['br'] = ('.br', lambda f: BrotliWriter(f))
+PRECOMPRESSED_ENCODINGS['gzip'] = ('.gz', lambda f: gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6))
+
+# Files smaller than this aren't worth compressing
+PRECOMPRESS_MIN_SIZE = 1024
+
+ETAG_CACHE_SIZE = 1024
+etag_cache = OrderedDict()
+etag_lock = threading.Lock()
+
+# Serialized mappings reused between submissions, inside UPLOAD_FOLDER
+SERIALIZATION_CACHE_FOLDER = '.cache'
+# Converted and compressed copies of generated files, inside
+# SERIALIZATION_CACHE_FOLDER, in a folder named after the source's path
+VARIANT_FOLDER = 'variants'
+
+# Uploaded files, stored once per content hash, inside UPLOAD_FOLDER
+BLOB_FOLDER = '.blobs'
+
+# Parsed interlinking queries kept in memory, on top of their analyses in
+# SERIALIZATION_CACHE_FOLDER
+QUERY_ANALYSIS_CACHE_SIZE = 256
+# Part of every analysis key; bumped whenever normalize_sparql_query changes
+# so analyses stored under the old normalization aren't served again
+QUERY_ANALYSIS_KEY_VERSION = 2
+query_analysis_cache = OrderedDict()
+query_analysis_lock = threading.Lock()
+
+# Run /submit_metadata in a background process pool instead of inside the request.
+# JOB_WORKERS job processes are shared out between the WEB_CONCURRENCY server
+# processes (set by gunicorn.conf.py), each of which gets at least one.
+app.config['ASYNC_METADATA_JOBS'] = os.getenv('ASYNC_METADATA_JOBS', '0') == '1'
+app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', os.cpu_count() or 1))
+app.config['WEB_CONCURRENCY'] = int(os.getenv('WEB_CONCURRENCY', 1))
+
+# Submissions beyond this many queued or running jobs, counted in the jobs
+# table across all server processes, are turned away with a 503. Jobs still
+# queued or running after JOB_STALE_AFTER seconds were lost with their server
+# process and no longer count.
+app.config['JOB_QUEUE_SIZE'] = int(os.getenv('JOB_QUEUE_SIZE', 16))
+app.config['JOB_STALE_AFTER'] = int(os.getenv('JOB_STALE_AFTER', 3600))
+
+# Settings a job worker process needs from the parent
+JOB_CONFIG_KEYS = ['UPLOAD_FOLDER', 'DATABASE', 'GRAPH_CACHE_MAX_TRIPLES']
+
+# Seconds the directory of a /batch_annotate request, with its outputs, is kept
+app.config['BATCH_TTL'] = int(os.getenv('BATCH_TTL', 24 * 60 * 60))
+# Where a batch's report is written, inside its directory, once the batch is done
+BATCH_REPORT = '.report.json'
+
+# Files picked up by the batch annotator
+MAPPING_FILE_EXTENSIONS = ('.ttl', '.rdf', '.xml', '.nt', '.nq', '.rq')
+
+job_executor = None
+job_lock = threading.Lock()
+
+# Remote SPARQL endpoint (e.g. a GraphDB repository) that /sparql forwards queries to
+app.config['GRAPHDB_URL'] = os.getenv('GRAPHDB_URL')
+app.config['SPARQL_CONNECT_TIMEOUT'] = float(os.getenv('SPARQL_CONNECT_TIMEOUT', 5))
+app.config['SPARQL_TIMEOUT'] = float(os.getenv('SPARQL_TIMEOUT', 60))
+
+# Queries proxied at the same time, and how long a query waits for a free slot
+app.config['SPARQL_MAX_CONCURRENCY'] = int(os.getenv('SPARQL_MAX_CONCURRENCY', 8))
+app.config['SPARQL_QUEUE_TIMEOUT'] = float(os.getenv('SPARQL_QUEUE_TIMEOUT', 10))
+
+SPARQL_CHUNK_SIZE = 64 * 1024
+# String literals and IRIs, which are kept as written, or a run of whitespace
+# and comments, which is not
+SPARQL_TOKEN = re.compile(r'("""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|<[^<>"{}|^`\\\x00-\x20]*>)'
+                          r'|(?:\s|#[^\n]*)+')
+
+# Where /sparql runs queries: 'remote' forwards them to GRAPHDB_URL, 'local' runs
+# them against an on-disk store of everything MetaMap has generated
+app.config['SPARQL_BACKEND'] = os.getenv('SPARQL_BACKEND', 'remote' if app.config['GRAPHDB_URL'] else 'local')
+app.config['METADATA_STORE'] = os.getenv('METADATA_STORE', 'metadata_store')
+
+# Number of local query results kept in memory
+app.config['SPARQL_CACHE_SIZE'] = int(os.getenv('SPARQL_CACHE_SIZE', 256))
+
+sparql_session = None
+sparql_slots = None
+sparql_lock = threading.Lock()
+
+metadata_store = None
+metadata_store_lock = threading.Lock()
+sparql_query_executor = None
+sparql_result_cache = OrderedDict()
+
+FOAF = Namespace("http://xmlns.com/foaf/0.1/")
+DCMI = Namespace("http://purl.org/dc/terms/")
+METAG = Namespace("http://example.com/metag/")
+EX = Namespace("http://example.com/")
+ONTOLOGY = Namespace("http://example.com/ontology#")
+XSD = Namespace("http://www.w3.org/2001/XMLSchema#")
+ALIGN = Namespace("http://knowledgeweb.semanticweb.org/heterogeneity/alignment#")
+RR = Namespace("http://www.w3.org/ns/r2rml#")
+RML = Namespace("http://semweb.mmlab.be/ns/rml#")
+
+# Constraints an uploaded mapping has to meet for each mapping type, checked
+# once at upload time. A shape targets the subjects of a class and/or the
+# objects of a predicate, and lists what they need as (any of these
+# predicates, min count, max count or None, message). Shapes only look at a
+# subject's own statements, so an upload is checked in the same streaming
+# pass that counts its triples. Interlinking has no shapes: a query is
+# analysed instead (see analyze_interlink_query), and one that doesn't parse
+# is still annotated as text.
+MAPPING_SHAPES = {
+    'Uplift Mapping': [
+        ('TriplesMap', RR.TriplesMap, None, [
+            ((RML.logicalSource, RR.logicalTable), 1, 1, "needs one rml:logicalSource or rr:logicalTable"),
+            ((RR.subjectMap, RR.subject), 1, 1, "needs one rr:subjectMap or rr:subject"),
+        ]),
+        ('PredicateObjectMap', None, RR.predicateObjectMap, [
+            ((RR.predicate, RR.predicateMap), 1, None, "needs an rr:predicate or rr:predicateMap"),
+            ((RR.object, RR.objectMap), 1, None, "needs an rr:object or rr:objectMap"),
+        ]),
+    ],
+    'Ontologies Alignment': [
+        ('Alignment', ALIGN.Alignment, None, [
+            ((ALIGN.map,), 1, None, "has no cells (align:map)"),
+        ]),
+        ('Cell', ALIGN.Cell, ALIGN.map, [
+            ((ALIGN.entity1,), 1, 1, "needs one align:entity1"),
+            ((ALIGN.entity2,), 1, 1, "needs one align:entity2"),
+            ((ALIGN.relation,), 1, 1, "needs one align:relation"),
+        ]),
+    ],
+    'Interlinking': [],
+}
+# The class a mapping of each type annotates, which an upload needs at least
+# one subject of and which tells /upload what type a mapping is
+MAPPING_TYPE_CLASSES = {'Uplift Mapping': RR.TriplesMap, 'Ontologies Alignment': ALIGN.Alignment}
+# Violations listed on the upload page, the rest are counted
+MAX_REPORTED_VIOLATIONS = 10
+
+
+def compile_mapping_shapes(mapping_shapes):
+    # Key everything by the N-Triples form statements are scanned in: returns
+    # ({type: [(name, class, predicate, [(predicates, min, max, message)])]},
+    # target classes, target predicates, constrained predicates)
+    compiled = {}
+    classes, target_predicates, predicates = set(), set(), set()
+    for mapping_type, shapes in mapping_shapes.items():
+        compiled[mapping_type] = []
+        for name, rdf_class, target_predicate, constraints in shapes:
+            rdf_class = rdf_class.n3() if rdf_class else None
+            target_predicate = target_predicate.n3() if target_predicate else None
+            constraints = [(frozenset(p.n3() for p in alternatives), min_count, max_count, message)
+                           for alternatives, min_count, max_count, message in constraints]
+            compiled[mapping_type].append((name, rdf_class, target_predicate, constraints))
+            classes.add(rdf_class)
+            target_predicates.add(target_predicate)
+            for alternatives, _, _, _ in constraints:
+                predicates |= alternatives
+    classes |= {rdf_class.n3() for rdf_class in MAPPING_TYPE_CLASSES.values()}
+    classes.discard(None)
+    target_predicates.discard(None)
+    return compiled, classes, target_predicates, predicates
+
+
+COMPILED_MAPPING_SHAPES, SHAPE_CLASSES, SHAPE_TARGET_PREDICATES, SHAPE_PREDICATES = \
+    compile_mapping_shapes(MAPPING_SHAPES)
+
+# Metadata fields collected by add_metadata.html as (form key, predicate, datatype).
+# Used for the named graph and the Uplift/Ontologies Alignment RDF-star annotations.
+METADATA_FIELDS = [
+    ('fname', FOAF.givenName, None),
+    ('lname', FOAF.familyName, None),
+    ('background', FOAF.background, None),
+    ('role', FOAF.role, None),
+    ('organization', FOAF.organization, None),
+
+    ('requirement', METAG.purpose, None),
+    ('mappingType', METAG.mappingType, None),
+    ('mappingDomain', METAG.mappingDomain, None),
+    ('mappingAssumptions', METAG.mappingAssumptions, None),
+    ('technicalRequirement', METAG.technicalRequirement, None),
+    ('risksIssues', METAG.risksIssues, None),
+
+    ('InputURI', DCMI.source, None),
+    ('InputSource', DCMI.creator, None),
+
+    ('StartDate', METAG.startDate, None),
+    ('EndDate', METAG.endDate, None),
+    ('Tool', METAG.tool, None),
+    ('MappingMethod', METAG.mappingMethod, None),
+
+    ('mappingURI', METAG.mappingURI, None),
+    ('mappingName', METAG.mappingName, None),
+    ('mappingAlgorithm', METAG.mappingAlgorithm, None),
+    ('mappingFormat', METAG.mappingFormat, None),
+
+    ('testingURI', METAG.testingURI, None),
+    ('testingName', METAG.testingName, None),
+    ('testingType', METAG.testingType, None),
+    ('testingDate', METAG.testingDate, None),
+    ('testingResult', METAG.testingResult, None),
+
+    ('publisherName', METAG.publisherName, None),
+    ('publisherSource', METAG.publisherSource, None),
+    ('versionNumber', METAG.versionNumber, None),
+    ('versionDateTime', METAG.versionDateTime, None),
+]
+
+# Interlinking annotations use their own vocabulary. A tuple of form keys is
+# joined with spaces into one value.
+INTERLINK_METADATA_FIELDS = [
+    (('fname', 'lname'), DCMI.creator, None),
+    ('requirement', DCMI.purpose, None),
+    ('Tool', EX.toolUsed, None),
+    ('StartDate', DCMI.created, XSD.date),
+    ('MappingMethod', EX.mappingMethod, None),
+    ('mappingDomain', EX.mappingDomain, None),
+    ('mappingURI', EX.mappingURI, None),
+    ('mappingName', EX.mappingName, None),
+    ('mappingAlgorithm', EX.mappingAlgorithm, None),
+    ('mappingFormat', EX.mappingFormat, None),
+    ('testingURI', EX.testingURI, None),
+    ('testingName', EX.testingName, None),
+    ('testingType', EX.testingType, None),
+    ('testingDate', EX.testingDate, XSD.date),
+    ('testingResult', EX.testingResult, None),
+    ('publisherName', EX.publisherName, None),
+    ('publisherSource', EX.publisherSource, None),
+    ('versionNumber', EX.versionNumber, None),
+    ('versionDateTime', EX.versionDateTime, XSD.dateTime),
+]
+
+
+def compile_metadata_schema(fields):
+    # Resolve everything that doesn't depend on the submitted values up front:
+    # the form keys to read, the predicate and its N3 form, and the datatype suffix
+    schema = []
+    for keys, predicate, datatype in fields:
+        if isinstance(keys, str):
+            keys = (keys,)
+        datatype_suffix = f"^^{datatype.n3()}" if datatype is not None else ""
+        schema.append((keys, predicate, predicate.n3(), datatype_suffix))
+    return schema
+
+
+def field_value(keys, form_data):
+    if len(keys) == 1:
+        return form_data.get(keys[0])
+    return ' '.join(str(form_data.get(key)) for key in keys)
+
+
+def metadata_values(schema, form_data):
+    # Yield (predicate, value) for each field of the schema
+    for keys, predicate, _, _ in schema:
+        yield predicate, field_value(keys, form_data)
+
+
+def nt_literal(value):
+    # N-Triples has no long strings, so escape what Literal.n3() would triple-quote
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+    return f'"{escaped}"'
+
+
+def render_annotations(schema, form_data, output_format='turtle'):
+    # The "predicate object" pairs for the submitted metadata, in Turtle or,
+    # for the line based formats, N-Triples syntax
+    render_literal = (lambda value: Literal(value).n3()) if output_format == 'turtle' else nt_literal
+    return [
+        f"{predicate_n3} {render_literal(field_value(keys, form_data))}{datatype_suffix}"
+        for keys, _, predicate_n3, datatype_suffix in schema
+    ]
+
+
+def render_annotation_block(annotations):
+    # The Turtle predicate-object list that follows each << s p o >> subject
+    return " ;\n".join(f"    {annotation}" for annotation in annotations) + " .\n\n"
+
+
+METADATA_SCHEMA = compile_metadata_schema(METADATA_FIELDS)
+INTERLINK_METADATA_SCHEMA = compile_metadata_schema(INTERLINK_METADATA_FIELDS)
+
+# Every submission gets a catalog row with one column per metadata field
+CATALOG_FIELDS = [key for key, _, _ in METADATA_FIELDS]
+CATALOG_DATE_FIELDS = ['StartDate', 'EndDate', 'testingDate', 'versionDateTime', 'created_at']
+CATALOG_INDEXED_FIELDS = ['mappingType', 'organization', 'Tool', 'participant_id'] + CATALOG_DATE_FIELDS
+CATALOG_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS metadata_catalog (\n"
+    "    id INTEGER PRIMARY KEY,\n"
+    "    created_at REAL NOT NULL,\n"
+    "    participant_id TEXT,\n"
+    "    file_name TEXT,\n"
+    "    content_hash TEXT,\n"
+    "    named_graph_path TEXT,\n"
+    "    rdf_star_path TEXT,\n"
+    + ''.join(f'    "{key}" TEXT,\n' for key in CATALOG_FIELDS).rstrip(',\n')
+    + "\n);\n"
+    + ''.join(f'CREATE INDEX IF NOT EXISTS metadata_catalog_{key} ON metadata_catalog ("{key}");\n'
+              for key in CATALOG_INDEXED_FIELDS)
+)
+
+# SQLite database holding server-side state such as upload records
+app.config['DATABASE'] = os.getenv('METAMAP_DATABASE', 'metamap.db')
+
+# Seconds an upload is kept around waiting for /submit_metadata
+app.config['UPLOAD_TTL'] = int(os.getenv('UPLOAD_TTL', 24 * 60 * 60))
+
+# Participant codes are reserved from the shuffled pool this many at a time per
+# process, and the code/participant/time log is written in batches of up to
+# CODE_LOG_BATCH_SIZE entries, at least every CODE_LOG_FLUSH_INTERVAL seconds
+app.config['CODE_BLOCK_SIZE'] = int(os.getenv('CODE_BLOCK_SIZE', 16))
+app.config['CODE_LOG_BATCH_SIZE'] = int(os.getenv('CODE_LOG_BATCH_SIZE', 32))
+app.config['CODE_LOG_FLUSH_INTERVAL'] = float(os.getenv('CODE_LOG_FLUSH_INTERVAL', 1))
+
+code_lock = threading.Lock()
+reserved_codes = []
+code_log = []
+code_log_flushed_at = 0.0
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    upload_id TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    content_hash TEXT,
+    rdf_format TEXT,
+    participant_id TEXT,
+    start_time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uploads_start_time ON uploads (start_time);
+CREATE TABLE IF NOT EXISTS indexed_metadata_files (
+    file_path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    content_hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL,
+    rdf_format TEXT,
+    triple_count INTEGER,
+    triples_map_count INTEGER,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blob_validations (
+    content_hash TEXT NOT NULL,
+    rdf_format TEXT NOT NULL,
+    mapping_types TEXT NOT NULL,
+    violations TEXT NOT NULL,
+    PRIMARY KEY (content_hash, rdf_format)
+);
+CREATE TABLE IF NOT EXISTS participant_codes (
+    code TEXT PRIMARY KEY,
+    participant_id TEXT,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS code_pool (
+    position INTEGER PRIMARY KEY,
+    code TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS code_pool_state (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    next_position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS export_watermarks (
+    consumer TEXT PRIMARY KEY,
+    last_catalog_id INTEGER NOT NULL,
+    exported_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metric_snapshots (
+    worker TEXT PRIMARY KEY,
+    snapshot TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    stage TEXT,
+    unique_code TEXT,
+    named_graph_path TEXT,
+    rdf_star_path TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+"""
+
+initialized_databases = set()
+
+
+def connect_db():
+    database = app.config['DATABASE']
+    conn = sqlite3.connect(database, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if database not in initialized_databases:
+        # WAL lets the worker processes read while one of them writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(DB_SCHEMA + CATALOG_SCHEMA)
+        initialized_databases.add(database)
+    return conn
+
+
+def create_upload_record(file_name, file_path, content_hash, rdf_format, participant_id):
+    # Only the returned id goes into the session cookie, everything else stays here
+    upload_id = secrets.token_urlsafe(16)
+    with connect_db() as conn:
+        conn.execute(
+            "INSERT INTO uploads (upload_id, file_name, file_path, content_hash, rdf_format, participant_id, start_time) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (upload_id, file_name, file_path, content_hash, rdf_format, participant_id, time.time()))
+    conn.close()
+    return upload_id
+
+
+def get_upload_record(upload_id):
+    if not upload_id:
+        return None
+    conn = connect_db()
+    row = conn.execute("SELECT * FROM uploads WHERE upload_id = ?", (upload_id,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def purge_expired_uploads():
+    # Drop uploads that were never submitted, releasing their blobs
+    cutoff = time.time() - app.config['UPLOAD_TTL']
+    with connect_db() as conn:
+        expired = conn.execute("SELECT upload_id, file_path, content_hash FROM uploads WHERE start_time < ?",
+                               (cutoff,)).fetchall()
+        conn.execute("DELETE FROM uploads WHERE start_time < ?", (cutoff,))
+        for row in expired:
+            if row['content_hash'] and row['file_path'] == blob_path(row['content_hash']):
+                release_blob(conn, row['content_hash'])
+            elif os.path.exists(row['file_path']) and not conn.execute(
+                    "SELECT 1 FROM uploads WHERE file_path = ?", (row['file_path'],)).fetchone():
+                # Saved under its own name before the blob store
+                os.remove(row['file_path'])
+    conn.close()
+    if expired:
+        logging.debug(f"Purged {len(expired)} expired uploads")
+
+    # Serialized mappings nobody has reused within the TTL
+    cache_folder = os.path.join(app.config['UPLOAD_FOLDER'], SERIALIZATION_CACHE_FOLDER)
+    if os.path.isdir(cache_folder):
+        cache_files = os.listdir(cache_folder)
+        expired_hashes = {name.split('.', 1)[0] for name in cache_files if name.endswith(('.body', '.scanned', '.query.json'))
+                          and os.path.getmtime(os.path.join(cache_folder, name)) < cutoff}
+        for name in cache_files:
+            if name.split('.', 1)[0] in expired_hashes:
+                os.remove(os.path.join(cache_folder, name))
+    purge_file_variants(cutoff)
+
+
+def purge_file_variants(cutoff):
+    # Drop converted and compressed copies whose source is gone, or that
+    # nobody has fetched since cutoff
+    upload_folder = os.path.realpath(app.config['UPLOAD_FOLDER'])
+    variant_folder = os.path.join(upload_folder, SERIALIZATION_CACHE_FOLDER, VARIANT_FOLDER)
+    for root, _, files in os.walk(variant_folder, topdown=False):
+        source = os.path.join(upload_folder, os.path.relpath(root, variant_folder))
+        for name in files:
+            path = os.path.join(root, name)
+            if not os.path.isfile(source) or os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        if root != variant_folder and not os.listdir(root):
+            os.rmdir(root)
+
+
+def save_upload_stream(file):
+    # Copy the upload into the blob store chunk by chunk while hashing it, and
+    # keep the first bytes around for format sniffing. Returns the content
+    # hash, which the caller holds a reference to, and the head.
+    sha = hashlib.sha256()
+    head = b''
+    size = 0
+    blob_folder = os.path.join(app.config['UPLOAD_FOLDER'], BLOB_FOLDER)
+    os.makedirs(blob_folder, exist_ok=True)
+    tmp_path = os.path.join(blob_folder, f"{secrets.token_hex(8)}.part")
+    start = time.perf_counter()
+    with timed_stage('upload_write'), open(tmp_path, 'wb') as f:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+            if len(head) < UPLOAD_SNIFF_SIZE:
+                head += chunk[:UPLOAD_SNIFF_SIZE - len(head)]
+            sha.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    content_hash = sha.hexdigest()
+    store_blob(tmp_path, content_hash, size)
+
+    seconds = time.perf_counter() - start
+    observe('metamap_upload_bytes_total', size)
+    if seconds > 0:
+        observe('metamap_upload_bytes_per_second', size / seconds)
+    return content_hash, head
+
+
+def blob_path(content_hash):
+    # Sharded on the first bytes of the hash so no directory gets too large
+    return os.path.join(app.config['UPLOAD_FOLDER'], BLOB_FOLDER, content_hash[:2], content_hash[2:4], content_hash)
+
+
+def store_blob(tmp_path, content_hash, size):
+    # Rename a completely written file into the blob store and take a
+    # reference to it. An identical file that's already stored is kept and the
+    # new copy dropped, so uploads of the same content share one blob.
+    path = blob_path(content_hash)
+    conn = connect_db()
+    try:
+        with conn:
+            # Hold the write lock while touching the file so a concurrent
+            # release_blob can't delete it between the check and the rename
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO blobs (content_hash, size, refcount, created_at) VALUES (?, ?, 1, ?) "
+                         "ON CONFLICT (content_hash) DO UPDATE SET refcount = refcount + 1",
+                         (content_hash, size, time.time()))
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+    finally:
+        conn.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+def release_blob(conn, content_hash):
+    # Drop a reference taken by store_blob, deleting the blob with the last
+    # one. Runs inside the caller's transaction on conn.
+    conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE content_hash = ?", (content_hash,))
+    row = conn.execute("SELECT refcount FROM blobs WHERE content_hash = ?", (content_hash,)).fetchone()
+    if row is not None and row['refcount'] <= 0:
+        conn.execute("DELETE FROM blobs WHERE content_hash = ?", (content_hash,))
+        conn.execute("DELETE FROM blob_validations WHERE content_hash = ?", (content_hash,))
+        path = blob_path(content_hash)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def discard_upload(content_hash):
+    # Release the blob of an upload that was rejected before it got a record
+    with connect_db() as conn:
+        release_blob(conn, content_hash)
+    conn.close()
+
+
+def blob_triple_counts(content_hash, rdf_format):
+    # (triples, TriplesMaps) recorded when this content was first uploaded in
+    # rdf_format, or None
+    conn = connect_db()
+    row = conn.execute("SELECT triple_count, triples_map_count FROM blobs WHERE content_hash = ? AND rdf_format = ?",
+                       (content_hash, rdf_format)).fetchone()
+    conn.close()
+    if row is None or row['triple_count'] is None:
+        return None
+    return row['triple_count'], row['triples_map_count']
+
+
+def record_blob_triple_counts(content_hash, rdf_format, counts):
+    with connect_db() as conn:
+        conn.execute("UPDATE blobs SET rdf_format = ?, triple_count = ?, triples_map_count = ? WHERE content_hash = ?",
+                     (rdf_format, *counts, content_hash))
+    conn.close()
+
+
+def blob_validation(content_hash, rdf_format):
+    # (mapping types, {mapping type: violations}) recorded when this content
+    # was first uploaded in rdf_format, or None
+    conn = connect_db()
+    row = conn.execute("SELECT mapping_types, violations FROM blob_validations WHERE content_hash = ? AND rdf_format = ?",
+                       (content_hash, rdf_format)).fetchone()
+    conn.close()
+    if row is None:
+        return None
+    return json.loads(row['mapping_types']), json.loads(row['violations'])
+
+
+def record_blob_validation(content_hash, rdf_format, validation):
+    mapping_types, violations = validation
+    with connect_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO blob_validations (content_hash, rdf_format, mapping_types, violations) "
+                     "VALUES (?, ?, ?, ?)", (content_hash, rdf_format, json.dumps(mapping_types), json.dumps(violations)))
+    conn.close()
+
+
+def sniff_rdf_format(head, rdf_format):
+    # Recognise RDF/XML and Turtle from their first statement, falling back to
+    # the format guessed from the file extension
+    if b'\x00' in head:
+        return None
+    for line in head.lstrip(b'\xef\xbb\xbf').splitlines():
+        line = line.strip()
+        if not line or line.startswith(b'#'):
+            continue
+        if line.startswith(b'<?xml') or line.startswith(b'<rdf:RDF'):
+            return 'xml'
+        if line.lower().startswith((b'@prefix', b'@base', b'prefix ', b'base ')):
+            return 'turtle'
+        break
+    return rdf_format
+
+
+def read_upload_preview(file_path):
+    # Read at most UPLOAD_PREVIEW_LINES lines and UPLOAD_PREVIEW_BYTES bytes
+    # for Ack.html, so a file that is one enormous line isn't read whole
+    max_lines = app.config['UPLOAD_PREVIEW_LINES']
+    max_bytes = app.config['UPLOAD_PREVIEW_BYTES']
+    with open(file_path, 'rb') as f:
+        data = f.read(max_bytes + 1)
+    truncated = len(data) > max_bytes
+    # Not final, so a character cut in half at max_bytes is dropped rather than replaced
+    text = codecs.getincrementaldecoder('utf-8')(errors='replace').decode(data[:max_bytes])
+    lines = text.splitlines(keepends=True)
+    if len(lines) > max_lines:
+        lines = lines[:max_lines]
+        truncated = True
+    return ''.join(lines), truncated
+
+
+def violation_summary(violations):
+    summary = '; '.join(violations[:MAX_REPORTED_VIOLATIONS])
+    if len(violations) > MAX_REPORTED_VIOLATIONS:
+        summary += f" (and {len(violations) - MAX_REPORTED_VIOLATIONS} more)"
+    return summary
+
+
+def upload_rejected(message):
+    # The upload form is static/upload.html, there's no template to show the
+    # message on, so a rejected upload is answered with the reason itself
+    return message, 400
+
+
+@app.errorhandler(413)
+def upload_too_large(_error):
+    max_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return f"Uploaded file is too large, the limit is {max_mb} MB.", 413
 
 
 @app.route('/')
@@ -35,75 +1027,113 @@ def upload():
         file = request.files['file']
         participant_id = request.form.get('participant_id')
 
-        # Get file extension
-        filename = file.filename
-        file_extension = filename.rsplit('.', 1)[1].lower()
+        # Get file extension. The name is only used for display and to name
+        # the outputs, the file itself is stored under its content hash.
+        filename = os.path.basename(file.filename)
+        # A name without one is refused below like any other unknown type
+        file_extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
 
         # Handle RDF files
-        if file_extension in ['ttl', 'rdf', 'xml']:
+        if file_extension in ['ttl', 'rdf', 'xml', 'nt', 'nq']:
+            content_hash = None
             try:
                 # Guess RDF format
                 rdf_format = guess_format(filename)
                 if rdf_format is None:
-                    flash('Uploaded file is not a valid RDF format.')
-                    return render_template('upload.html', participant_id=participant_id)
-
-                # Save the RDF file
-                saved_file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-                file.save(saved_file_path)
-
-                # Parse the RDF file
-                g = Graph()
-                g.parse(saved_file_path, format=rdf_format)
-
-                # Successfully parsed the RDF file
-                session['start_time'] = time.time()
-                session['participant_id'] = participant_id
-
-                # Store file content for display
-                with open(saved_file_path, 'r', encoding='utf-8') as rdf_file:
-                    file_content = rdf_file.read()
+                    return upload_rejected('Uploaded file is not a valid RDF format.')
 
-                # Extract metadata if needed (optional)
-                # You can add more logic here to extract RDF metadata from the parsed graph
+                # Stream the RDF file into the blob store, hashing it on the way
+                content_hash, head = save_upload_stream(file)
+                saved_file_path = blob_path(content_hash)
 
-                session['file_content'] = file_content
-                session['uploaded_file_name'] = file.filename
-                return render_template('Ack.html', file_content=file_content, uploaded_file_name=file.filename, participant_id=participant_id)
+                # Trust the content over the extension when they disagree
+                rdf_format = sniff_rdf_format(head, rdf_format)
+                if rdf_format is None:
+                    discard_upload(content_hash)
+                    content_hash = None
+                    return upload_rejected('Uploaded file is not a valid RDF format.')
+
+                # Check that the RDF file parses and meets the shapes of its
+                # mapping type, streaming it when oxigraph can, otherwise
+                # parsing it into a graph kept for /submit_metadata. Content
+                # that was checked before isn't parsed again.
+                counts = blob_triple_counts(content_hash, rdf_format)
+                validation = blob_validation(content_hash, rdf_format)
+                if counts is None or validation is None:
+                    scanned = None
+                    if app.config['SCAN_MAPPING_SUBJECTS'] and rdf_format in SCANNABLE_FORMATS:
+                        with timed_stage('scan', format=rdf_format):
+                            scanned = scan_mapping_file(saved_file_path, rdf_format)
+                    if scanned is None:
+                        g = load_mapping_graph(saved_file_path, rdf_format, content_hash)
+                        with timed_stage('validate', format=rdf_format):
+                            scanned = check_mapping_graph(g)
+                    counts, validation = scanned
+                    record_blob_triple_counts(content_hash, rdf_format, counts)
+                    record_blob_validation(content_hash, rdf_format, validation)
+                triple_count, triples_map_count = counts
+
+                # Reject a mapping that is malformed for the type it looks like,
+                # before any metadata is generated for it
+                mapping_types, violations = validation
+                problems = [problem for mapping_type in mapping_types for problem in violations[mapping_type]]
+                if problems:
+                    discard_upload(content_hash)
+                    content_hash = None
+                    return upload_rejected(f"The mapping is not valid: {violation_summary(problems)}")
+
+                # Only show the start of the file, large mappings would not render anyway
+                file_content, truncated = read_upload_preview(saved_file_path)
+
+                # Successfully parsed the RDF file, remember it server-side
+                purge_expired_uploads()
+                session['upload_id'] = create_upload_record(filename, saved_file_path, content_hash,
+                                                            rdf_format, participant_id)
+
+                return render_template('Ack.html', file_content=file_content, truncated=truncated,
+                                       triple_count=triple_count, triples_map_count=triples_map_count,
+                                       uploaded_file_name=filename, participant_id=participant_id)
 
             except Exception as e:
-                # Catch any RDF parsing errors and flash a message
-                flash(f'Failed to parse RDF file: {str(e)}')
+                # Catch any RDF parsing errors and report them
+                if content_hash:
+                    discard_upload(content_hash)
                 logging.error(f"Failed to parse RDF file {filename}: {e}")
-                return render_template('upload.html', participant_id=participant_id)
+                return upload_rejected(f'Failed to parse RDF file: {str(e)}')
 
         # Handle SPARQL query (.rq) files
         elif file_extension == 'rq':
+            content_hash = None
             try:
                 # Save and display SPARQL query content
-                file_content = file.read().decode('utf-8')
-                saved_file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-                with open(saved_file_path, 'w', encoding='utf-8') as f:
-                    f.write(file_content)
-
-                session['start_time'] = time.time()
-                session['participant_id'] = participant_id
-                session['file_content'] = file_content
-                session['uploaded_file_name'] = file.filename
-
-                return render_template('Ack.html', file_content=file_content, uploaded_file_name=file.filename, participant_id=participant_id)
+                content_hash, _ = save_upload_stream(file)
+                saved_file_path = blob_path(content_hash)
+                file_content, truncated = read_upload_preview(saved_file_path)
+
+                # Analyse the query now, /submit_metadata finds it cached. A
+                # query that doesn't parse is still annotated, as text.
+                with open(saved_file_path, 'r', encoding='utf-8') as f:
+                    query_error = interlink_query_analysis(f.read()).get('error')
+
+                purge_expired_uploads()
+                session['upload_id'] = create_upload_record(filename, saved_file_path, content_hash,
+                                                            None, participant_id)
+                return render_template('Ack.html', file_content=file_content, truncated=truncated,
+                                       uploaded_file_name=filename, participant_id=participant_id,
+                                       query_error=query_error)
 
             except Exception as e:
-                flash(f'Failed to handle SPARQL query: {str(e)}')
+                if content_hash:
+                    discard_upload(content_hash)
                 logging.error(f"Failed to process SPARQL query {filename}: {e}")
-                return render_template('upload.html', participant_id=participant_id)
+                return upload_rejected(f'Failed to handle SPARQL query: {str(e)}')
 
         else:
             # Unsupported file type
-            flash('File type not allowed. Please upload RDF, XML, or SPARQL query (.rq) files.')
-            return redirect(request.url)
+            return upload_rejected('File type not allowed. Please upload RDF (Turtle, RDF/XML, N-Triples, N-Quads) or SPARQL query (.rq) files.')
 
-    return render_template('upload.html')
+    # The upload form is a static page
+    return redirect('/static/upload.html')
 
 
 
@@ -112,31 +1142,22 @@ def submit_metadata():
     if request.method == 'POST':
         form_data = request.form
 
-        # Store the list of all previously generated codes to ensure uniqueness
-        generated_codes = set()
+        upload_record = get_upload_record(session.get('upload_id'))
+        if upload_record is None:
+            return "Your upload has expired, please upload the mapping file again.", 400
 
-        # Generate a unique random code with 3 digits and 1 uppercase letter
-        def generate_random_code():
-            while True:
-                digits = ''.join(random.choices(string.digits,
-                                                k=3))  # 3 random digits
-                letter = random.choice(
-                    string.ascii_uppercase)  # 1 random uppercase letter
-                code = digits + letter  # Combine the digits and letter
+        participant_id = upload_record['participant_id']
 
-                if code not in generated_codes:
-                    generated_codes.add(code)
-                    return code
-
-        # Generate the code and store it in session
-        unique_code = generate_random_code()
-        session['unique_code'] = unique_code
-
-        participant_id = session.get('participant_id')
-        uploaded_file_name = session.get('uploaded_file_name')
+        # The upload was checked against every mapping type's shapes, so a
+        # mapping that doesn't fit the chosen type is refused before any work
+        mapping_type = form_data.get('mappingType')
+        validation = blob_validation(upload_record['content_hash'], upload_record['rdf_format'])
+        if validation is not None and validation[1].get(mapping_type):
+            return (f"The uploaded mapping is not a valid {mapping_type}: "
+                    f"{violation_summary(validation[1][mapping_type])}", 400)
 
         end_time = time.time()
-        start_time = session.get('start_time')
+        start_time = upload_record['start_time']
         if start_time:
             duration = end_time - start_time
         else:
@@ -146,24 +1167,20 @@ def submit_metadata():
             f"Participant {participant_id} took {duration} seconds to complete."
         )
 
-        g_named_graph = Graph()
-        g_rdf_star = Graph()
-
-        populate_named_graph(form_data, g_named_graph)
-        rdf_filename_rdf_star = populate_rdf_star(form_data, g_rdf_star,
-                                                  uploaded_file_name)
-
-        rdf_data_named_graph = g_named_graph.serialize(format='turtle')
-
-        timestamp = time.strftime("%Y%m%d%H%M%S")
-        duration_suffix = f"_{int(duration)}s" if duration is not None else ""
+        if app.config['ASYNC_METADATA_JOBS']:
+            # Hand the work to the job pool and let the browser poll for it
+            job_id, unique_code = enqueue_metadata_job(form_data.to_dict(), upload_record, duration, participant_id)
+            if job_id is None:
+                return "The server is busy generating metadata, please try again in a moment.", 503, {'Retry-After': '5'}
+            session['unique_code'] = unique_code
+            return redirect(url_for('job_status', job_id=job_id))
 
-        rdf_filename_named_graph = f"metadata_named_graph_{timestamp}{duration_suffix}.ttl"
-        rdf_named_graph_path = os.path.join(app.config['UPLOAD_FOLDER'],
-                                            rdf_filename_named_graph)
+        # Generate the code and store it in session
+        unique_code = allocate_participant_code(participant_id)
+        session['unique_code'] = unique_code
 
-        with open(rdf_named_graph_path, "w") as file_named_graph:
-            file_named_graph.write(rdf_data_named_graph)
+        with timed_stage('submit'):
+            rdf_named_graph_path, rdf_filename_rdf_star = generate_metadata(form_data, upload_record, duration)
 
         # Pass the paths for viewing or downloading
         return render_template('success.html',
@@ -172,402 +1189,1351 @@ def submit_metadata():
                                unique_code=unique_code)
 
 
+def allocate_participant_code(participant_id):
+    # Hand out the next code of 3 digits and 1 uppercase letter from a pool of
+    # every such code in random order, so no code is given out twice and there
+    # is nothing to retry as the pool runs out
+    with code_lock:
+        if not reserved_codes:
+            reserved_codes.extend(reserve_code_block(app.config['CODE_BLOCK_SIZE']))
+        code = reserved_codes.pop()
+        code_log.append((code, participant_id, time.time()))
+    flush_code_log()
+    return code
+
+
+def reserve_code_block(size):
+    # Take the next size codes of the pool for this process, creating the pool
+    # on first use. A process that dies leaves its unused codes unassigned.
+    conn = connect_db()
+    try:
+        with conn:
+            # Take the write lock up front so two processes can't both create the pool
+            conn.execute("BEGIN IMMEDIATE")
+            state = conn.execute("SELECT next_position FROM code_pool_state WHERE id = 0").fetchone()
+            if state is None:
+                fill_code_pool(conn)
+                start = 0
+            else:
+                start = state['next_position']
+            conn.execute("UPDATE code_pool_state SET next_position = ? WHERE id = 0", (start + size,))
+            codes = [row['code'] for row in conn.execute(
+                "SELECT code FROM code_pool WHERE position >= ? AND position < ? ORDER BY position DESC",
+                (start, start + size))]
+    finally:
+        conn.close()
+    if not codes:
+        raise RuntimeError("All participant codes have been handed out")
+    return codes
+
+
+def create_code_pool():
+    conn = connect_db()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM code_pool_state WHERE id = 0").fetchone() is None:
+                fill_code_pool(conn)
+    finally:
+        conn.close()
+
+
+def fill_code_pool(conn):
+    # Codes handed out before the pool existed stay taken
+    issued = {row['code'] for row in conn.execute("SELECT code FROM participant_codes")}
+    codes = [f"{number:03d}{letter}" for number in range(1000) for letter in string.ascii_uppercase]
+    codes = [code for code in codes if code not in issued]
+    random.SystemRandom().shuffle(codes)
+    conn.executemany("INSERT INTO code_pool (position, code) VALUES (?, ?)", enumerate(codes))
+    conn.execute("INSERT INTO code_pool_state (id, next_position) VALUES (0, 0)")
+
+
+def flush_code_log(force=False):
+    global code_log_flushed_at
+    with code_lock:
+        due = (force or len(code_log) >= app.config['CODE_LOG_BATCH_SIZE']
+               or time.time() - code_log_flushed_at >= app.config['CODE_LOG_FLUSH_INTERVAL'])
+        if not code_log or not due:
+            return
+        batch = code_log[:]
+        code_log.clear()
+        code_log_flushed_at = time.time()
+    with connect_db() as conn:
+        conn.executemany("INSERT OR REPLACE INTO participant_codes (code, participant_id, created_at) "
+                         "VALUES (?, ?, ?)", batch)
+    conn.close()
+
+
+@app.after_request
+def write_code_log(response):
+    flush_code_log()
+    return response
+
+
+atexit.register(flush_code_log, force=True)
+
+
+@app.cli.command('codes-export')
+@click.argument('filename', default='codes.csv')
+def codes_export(filename):
+    """Write every participant code handed out so far to a CSV file."""
+    flush_code_log(force=True)
+    conn = connect_db()
+    rows = conn.execute("SELECT code, participant_id, created_at FROM participant_codes ORDER BY created_at").fetchall()
+    conn.close()
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=['timestamp', 'user_id', 'code'])
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({
+                'timestamp': datetime.fromtimestamp(row['created_at']).strftime("%Y-%m-%d %H:%M:%S"),
+                'user_id': row['participant_id'],
+                'code': row['code'],
+            })
+    print(f"Wrote {len(rows)} codes to {filename}")
+
+
+def generate_metadata(form_data, upload_record, duration, progress=None):
+    # Write the named graph and RDF-star files for one submission and return their paths
+    g_named_graph = Graph()
+
+    populate_named_graph(form_data, g_named_graph)
+    if progress:
+        progress('rdf-star')
+    # mappingType comes from the client, so only known types become label values
+    mapping_type = form_data.get('mappingType')
+    with timed_stage('annotate', mapping_type=mapping_type if mapping_type in MAPPING_SHAPES else 'other'):
+        rdf_filename_rdf_star = populate_rdf_star(form_data, upload_record['file_name'],
+                                                  upload_record['content_hash'], upload_record['rdf_format'],
+                                                  upload_record['file_path'])
+
+    if progress:
+        progress('named graph')
+    output_format, compress = requested_output_format(form_data)
+
+    timestamp = time.strftime("%Y%m%d%H%M%S")
+    duration_suffix = f"_{int(duration)}s" if duration is not None else ""
+
+    # The random part keeps submissions finishing in the same second apart
+    rdf_filename_named_graph = (f"metadata_named_graph_{timestamp}{duration_suffix}_{secrets.token_hex(4)}"
+                                f"{output_extension(output_format, compress)}")
+    rdf_named_graph_path = os.path.join(app.config['UPLOAD_FOLDER'],
+                                        rdf_filename_named_graph)
+
+    with timed_stage('named_graph_write', format=output_format), atomic_write(rdf_named_graph_path, compress) as file_named_graph:
+        if output_format == 'turtle':
+            g_named_graph.serialize(destination=file_named_graph, format='turtle', encoding='utf-8')
+        else:
+            with statement_writer(file_named_graph, output_format, output_graph_name(rdf_named_graph_path)) as write_nt:
+                g_named_graph.serialize(destination=write_nt, format='nt', encoding='utf-8')
+    observe('metamap_output_bytes_total', os.path.getsize(rdf_named_graph_path), output='named_graph')
+
+    add_catalog_entry(form_data, upload_record, rdf_named_graph_path, rdf_filename_rdf_star)
+
+    return rdf_named_graph_path, rdf_filename_rdf_star
+
+
+def get_job_executor():
+    global job_executor
+    with job_lock:
+        if job_executor is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # Spawned rather than forked: server processes run several threads
+            workers = max(1, app.config['JOB_WORKERS'] // app.config['WEB_CONCURRENCY'])
+            job_executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                               initializer=reset_metrics)
+        return job_executor
+
+
+def discard_job_executor(executor):
+    # A worker that dies breaks its whole pool, so drop it and let the next
+    # submission start a fresh one
+    global job_executor
+    with job_lock:
+        if job_executor is executor:
+            job_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def submit_job(fn, *args):
+    # Run fn on the job pool, replacing the pool if it turns out to be broken
+    from concurrent.futures.process import BrokenProcessPool
+    executor = get_job_executor()
+    try:
+        future = executor.submit(fn, *args)
+    except BrokenProcessPool:
+        logging.warning("Job pool is broken, starting a new one")
+        discard_job_executor(executor)
+        executor = get_job_executor()
+        future = executor.submit(fn, *args)
+
+    def check_pool(f):
+        if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool):
+            discard_job_executor(executor)
+
+    future.add_done_callback(check_pool)
+    return future
+
+
+def enqueue_metadata_job(form_data, upload_record, duration, participant_id):
+    # Returns None instead of queueing when JOB_QUEUE_SIZE jobs are already
+    # waiting or running on any server process
+    job_id = create_job()
+    if job_id is None:
+        return None, None
+
+    # Only hand out a participant code once the job has its place in the queue
+    unique_code = allocate_participant_code(participant_id)
+    update_job(job_id, unique_code=unique_code)
+
+    # The worker process may not share our config, so pass along what it needs
+    config = {key: app.config[key] for key in JOB_CONFIG_KEYS}
+    try:
+        future = submit_job(run_metadata_job, job_id, form_data, upload_record, duration, config)
+    except Exception as e:
+        # Don't leave a queued row behind that no worker will ever pick up
+        logging.error(f"Could not start metadata job {job_id}: {e}")
+        update_job(job_id, status='failed', error=str(e), finished_at=time.time())
+        return job_id, unique_code
+    future.add_done_callback(lambda f: finish_metadata_job(job_id, f))
+    return job_id, unique_code
+
+
+def create_job(unique_code=None, stage=None):
+    # Add a queued job and return its id, or None when JOB_QUEUE_SIZE jobs
+    # are already waiting or running on any server process
+    job_id = secrets.token_urlsafe(16)
+    now = time.time()
+    conn = connect_db()
+    try:
+        with conn:
+            # Count and insert under the write lock so concurrent submissions
+            # can't both take the last place
+            conn.execute("BEGIN IMMEDIATE")
+            active = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running') AND created_at > ?",
+                                  (now - app.config['JOB_STALE_AFTER'],)).fetchone()[0]
+            if active >= app.config['JOB_QUEUE_SIZE']:
+                logging.warning("Metadata job queue is full, rejecting submission")
+                return None
+            conn.execute("INSERT INTO jobs (job_id, status, stage, unique_code, created_at) VALUES (?, 'queued', ?, ?, ?)",
+                         (job_id, stage, unique_code, now))
+    finally:
+        conn.close()
+    return job_id
+
+
+def run_metadata_job(job_id, form_data, upload_record, duration, config):
+    # Runs inside a worker process
+    app.config.update(config)
+    update_job(job_id, status='running', stage='starting')
+    try:
+        paths = generate_metadata(form_data, upload_record, duration,
+                                  progress=lambda stage: update_job(job_id, stage=stage))
+    finally:
+        # Job processes serve no requests, so publish their stage timings here
+        flush_metrics(force=True)
+    update_job(job_id, status='done', stage=None, named_graph_path=paths[0],
+               rdf_star_path=paths[1], finished_at=time.time())
+    return paths
+
+
+def finish_metadata_job(job_id, future):
+    error = future.exception()
+    if error is not None:
+        logging.error(f"Metadata job {job_id} failed: {error}")
+        update_job(job_id, status='failed', error=str(error), finished_at=time.time())
+
+
+def update_job(job_id, **fields):
+    assignments = ', '.join(f"{column} = ?" for column in fields)
+    with connect_db() as conn:
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+    conn.close()
+
+
+def get_job(job_id):
+    conn = connect_db()
+    row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    conn.close()
+    if row is None:
+        return None
+    job = dict(row)
+    # A job whose process died never finishes; the queue stopped counting it
+    # after JOB_STALE_AFTER, so report it as failed rather than pending forever
+    if job['status'] in ('queued', 'running') and job['created_at'] <= time.time() - app.config['JOB_STALE_AFTER']:
+        job.update(status='failed', error="The job did not finish in time.")
+    return job
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return "Unknown job.", 404
+
+    # Batches come from scripts, so they're always answered in JSON, with the
+    # batch's report once it's done
+    report_path = os.path.join(batch_directory(job_id), BATCH_REPORT)
+    if request.accept_mimetypes.best == 'application/json' or os.path.isdir(os.path.dirname(report_path)):
+        if job['status'] == 'done' and os.path.exists(report_path):
+            with open(report_path, 'rb') as f:
+                job['report'] = json.load(f)
+        return jsonify(job)
+
+    if job['status'] == 'done':
+        return render_template('success.html',
+                               rdf_data_path_named_graph=job['named_graph_path'],
+                               rdf_data_path_rdf_star=job['rdf_star_path'],
+                               unique_code=job['unique_code'])
+    if job['status'] == 'failed':
+        return f"Generating the metadata failed: {job['error']}", 500
+    return render_template('job_status.html', job=job)
+
+
+def find_mapping_files(directory):
+    # Mapping files under directory, relative to it, skipping MetaMap's own outputs
+    mapping_files = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.lower().endswith(MAPPING_FILE_EXTENSIONS):
+                continue
+            if '_rdf_star.' in name or name.startswith('metadata_named_graph_'):
+                continue
+            mapping_files.append(os.path.relpath(os.path.join(root, name), directory))
+    return sorted(mapping_files)
+
+
+def annotate_mapping_file(directory, file_name, form_data):
+    # Runs inside a batch worker process, annotating one file in place
+    app.config['UPLOAD_FOLDER'] = directory
+    file_size = os.path.getsize(os.path.join(directory, file_name))
+    start = time.perf_counter()
+    try:
+        rdf_star_path = populate_rdf_star(form_data, file_name)
+        if rdf_star_path is None:
+            raise ValueError(f"No RDF-star output for mapping type {form_data.get('mappingType')!r}")
+    except Exception as e:
+        return {'file': file_name, 'bytes': file_size, 'error': str(e)}
+    seconds = time.perf_counter() - start
+    return {
+        'file': file_name,
+        'bytes': file_size,
+        'seconds': seconds,
+        'bytes_per_second': file_size / seconds if seconds else None,
+        'rdf_star_path': rdf_star_path,
+    }
+
+
+def annotate_mapping_directory(directory, form_data, workers=None, on_result=None, submit=None):
+    # Annotate every mapping file under directory with the same metadata,
+    # one file per worker process, and return a report of the run. Files go
+    # through submit when given, otherwise to a pool of workers started for the run.
+    mapping_files = find_mapping_files(directory)
+    results = []
+    start = time.perf_counter()
+    from concurrent.futures import ProcessPoolExecutor
+    with nullcontext() if submit else ProcessPoolExecutor(max_workers=workers or app.config['JOB_WORKERS']) as pool:
+        submit = submit or pool.submit
+        futures = [submit(annotate_mapping_file, directory, file_name, form_data)
+                   for file_name in mapping_files]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if on_result:
+                on_result(result)
+    seconds = time.perf_counter() - start
+
+    total_bytes = sum(result['bytes'] for result in results)
+    return {
+        'files': len(results),
+        'failed': sum(1 for result in results if 'error' in result),
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'bytes_per_second': total_bytes / seconds if seconds else None,
+        'results': sorted(results, key=lambda result: result['file']),
+    }
+
+
+def extract_mapping_archive(archive, directory):
+    # Unpack a .zip or .tar(.gz) upload, refusing members that would land outside directory
+    import tarfile
+    import zipfile
+    root = os.path.realpath(directory)
+
+    def check_member(name):
+        target = os.path.realpath(os.path.join(root, name))
+        if os.path.commonpath([root, target]) != root:
+            raise ValueError(f"Archive member {name} is outside the batch directory")
+
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for name in zf.namelist():
+                check_member(name)
+            zf.extractall(root)
+    else:
+        archive.seek(0)
+        try:
+            with tarfile.open(fileobj=archive) as tf:
+                members = [member for member in tf.getmembers() if member.isfile() or member.isdir()]
+                for member in members:
+                    check_member(member.name)
+                tf.extractall(root, members=members)
+        except tarfile.TarError as e:
+            raise ValueError(str(e)) from e
+
+
+@app.route('/batch_annotate', methods=['POST'])
+def batch_annotate():
+    # Expects a 'metadata' JSON file (form field name -> value) and an 'archive' of mappings
+    try:
+        form_data = json.load(request.files['metadata'])
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': f"A valid metadata JSON file is required: {e}"}), 400
+
+    archive = request.files.get('archive')
+    if archive is None:
+        return jsonify({'error': "An archive of mapping files is required."}), 400
+
+    # A batch takes one place in the job queue and runs its files on the job
+    # pool, so batches and async submissions share one bound on the work
+    purge_expired_batches()
+    job_id = create_job(stage='batch')
+    if job_id is None:
+        return jsonify({'error': "The server is busy generating metadata, please try again in a moment."}), 503, \
+            {'Retry-After': '5'}
+
+    directory = batch_directory(job_id)
+    os.makedirs(directory)
+    try:
+        extract_mapping_archive(archive.stream, directory)
+    except Exception as e:
+        update_job(job_id, status='failed', error=str(e), finished_at=time.time())
+        shutil.rmtree(directory, ignore_errors=True)
+        if isinstance(e, ValueError):
+            return jsonify({'error': f"Could not read the archive: {e}"}), 400
+        raise
+
+    # The files are annotated in the background; poll /jobs/<job_id> for the report
+    update_job(job_id, status='running')
+    threading.Thread(target=run_batch_job, args=(job_id, directory, form_data), daemon=True).start()
+    status_url = url_for('job_status', job_id=job_id)
+    return jsonify({'job_id': job_id, 'status': status_url}), 202, {'Location': status_url}
+
+
+def batch_directory(job_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], f"batch_{job_id}")
+
+
+def run_batch_job(job_id, directory, form_data):
+    # Runs on a thread of the server process, handing the files to the job pool
+    try:
+        report = annotate_mapping_directory(directory, form_data, submit=submit_job)
+        with atomic_write(os.path.join(directory, BATCH_REPORT)) as f:
+            f.write(json.dumps(report).encode('utf-8'))
+    except Exception as e:
+        logging.error(f"Batch {job_id} failed: {e}")
+        update_job(job_id, status='failed', error=str(e), finished_at=time.time())
+        shutil.rmtree(directory, ignore_errors=True)
+        return
+    update_job(job_id, status='done', stage=None, finished_at=time.time())
+    logging.info(f"Batch {directory}: {report['files']} files, {report['failed']} failed, "
+                 f"{report['seconds']:.1f}s")
+
+
+def purge_expired_batches():
+    # Batch directories, with their extracted mappings and outputs, are kept
+    # for BATCH_TTL seconds so the outputs in the report can be fetched
+    cutoff = time.time() - app.config['BATCH_TTL']
+    upload_folder = app.config['UPLOAD_FOLDER']
+    if not os.path.isdir(upload_folder):
+        return
+    for name in os.listdir(upload_folder):
+        path = os.path.join(upload_folder, name)
+        if name.startswith('batch_') and os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+            logging.debug(f"Purged expired batch {path}")
+
+
+def add_catalog_entry(form_data, upload_record, named_graph_path, rdf_star_path, created_at=None):
+    columns = ['created_at', 'participant_id', 'file_name', 'content_hash',
+               'named_graph_path', 'rdf_star_path'] + CATALOG_FIELDS
+    values = [created_at or time.time(), upload_record.get('participant_id'), upload_record.get('file_name'),
+              upload_record.get('content_hash'), named_graph_path, rdf_star_path]
+    values += [form_data.get(key) for key in CATALOG_FIELDS]
+    quoted = ', '.join(f'"{column}"' for column in columns)
+    placeholders = ', '.join('?' for _ in columns)
+    with connect_db() as conn:
+        conn.execute(f"INSERT INTO metadata_catalog ({quoted}) VALUES ({placeholders})", values)
+    conn.close()
+
+
+def search_catalog(filters, limit=100, offset=0):
+    # filters maps a catalog column to a value to match exactly, or a date
+    # column suffixed with _after/_before to an inclusive bound
+    conditions = []
+    params = []
+    for name, value in filters.items():
+        if name.endswith(('_after', '_before')):
+            column, bound = name.rsplit('_', 1)
+            if column not in CATALOG_DATE_FIELDS:
+                raise ValueError(f"Cannot filter {column} by date")
+            conditions.append(f'"{column}" {">=" if bound == "after" else "<="} ?')
+            params.append(float(value) if column == 'created_at' else value)
+        elif name in CATALOG_FIELDS or name in ('participant_id', 'file_name', 'content_hash'):
+            conditions.append(f'"{name}" = ?')
+            params.append(value)
+        else:
+            raise ValueError(f"Unknown catalog field {name}")
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    conn = connect_db()
+    rows = conn.execute(f"SELECT * FROM metadata_catalog {where} ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                        (*params, limit, offset)).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+@app.route('/catalog/search')
+def catalog_search():
+    # e.g. /catalog/search?organization=TCD&mappingType=Uplift+Mapping&testingDate_after=2024-06-01
+    filters = request.args.to_dict()
+    try:
+        limit = min(int(filters.pop('limit', 100)), 1000)
+        offset = int(filters.pop('offset', 0))
+    except ValueError:
+        return jsonify({'error': "limit and offset must be integers"}), 400
+    try:
+        results = search_catalog(filters, limit, offset)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'count': len(results), 'results': results})
+
+
+@app.cli.command('catalog-backfill')
+def catalog_backfill():
+    """Add catalog rows for metadata_named_graph_*.ttl files written before the catalog existed."""
+    conn = connect_db()
+    known = {row[0] for row in conn.execute("SELECT named_graph_path FROM metadata_catalog")}
+    conn.close()
+
+    keys_by_predicate = {predicate: key for key, predicate, _ in METADATA_FIELDS}
+    added = 0
+    for name in sorted(os.listdir(app.config['UPLOAD_FOLDER'])):
+        path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+        if not (name.startswith('metadata_named_graph_') and name.endswith('.ttl')) or path in known:
+            continue
+        g = Graph()
+        g.parse(path, format='turtle')
+        form_data = {keys_by_predicate[p]: str(o) for _, p, o in g if p in keys_by_predicate}
+        add_catalog_entry(form_data, {}, path, None, created_at=os.path.getmtime(path))
+        added += 1
+    print(f"Added {added} catalog entries")
+
+
+# Catalog rows read at a time while exporting, and uncompressed bytes per
+# chunk handed to the response or file
+EXPORT_PAGE_SIZE = 500
+EXPORT_CHUNK_SIZE = 256 * 1024
+
+
+def submission_graph_name(catalog_id):
+    return URIRef(f"http://example.com/metag/submission/{catalog_id}")
+
+
+def get_export_watermark(consumer):
+    # Catalog id of the last submission exported to consumer, 0 if none
+    conn = connect_db()
+    row = conn.execute("SELECT last_catalog_id FROM export_watermarks WHERE consumer = ?", (consumer,)).fetchone()
+    conn.close()
+    return row['last_catalog_id'] if row else 0
+
+
+def set_export_watermark(consumer, last_catalog_id):
+    with connect_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO export_watermarks (consumer, last_catalog_id, exported_at) VALUES (?, ?, ?)",
+                     (consumer, last_catalog_id, time.time()))
+    conn.close()
+
+
+def export_range(since):
+    # (since, until): the catalog ids after since that exist now. Submissions
+    # made during the export are left for the next one.
+    conn = connect_db()
+    until = conn.execute("SELECT COALESCE(MAX(id), 0) FROM metadata_catalog").fetchone()[0]
+    conn.close()
+    return since, max(since, until)
+
+
+def export_catalog_rows(since, until):
+    last_id = since
+    while True:
+        conn = connect_db()
+        rows = conn.execute("SELECT id, named_graph_path, rdf_star_path FROM metadata_catalog "
+                            "WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                            (last_id, until, EXPORT_PAGE_SIZE)).fetchall()
+        conn.close()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1]['id']
+
+
+def export_chunks(since, until, output_format='nq'):
+    # Stream the generated files of the submissions with catalog ids in
+    # (since, until] as one N-Quads or TriG dataset, each submission's named
+    # graph and RDF-star files in a graph of its own. Files are parsed
+    # statement by statement and nothing but the current chunk is kept.
+    import pyoxigraph
+    buffer = []
+    size = 0
+    quads = 0
+    for row in export_catalog_rows(since, until):
+        graph = submission_graph_name(row['id']).n3()
+        if output_format == 'trig':
+            buffer.append(f"{graph} {{\n")
+        for file_path in (row['named_graph_path'], row['rdf_star_path']):
+            if not file_path or not os.path.exists(file_path):
+                continue
+            source_format = output_format_for_path(file_path)[0]
+            try:
+                with open_metadata_file(file_path) as f:
+                    for statement in pyoxigraph.parse(f, OUTPUT_FORMATS[source_format][1],
+                                                      base_iri=str(output_graph_name(file_path))):
+                        if isinstance(statement, pyoxigraph.Quad):
+                            statement = statement.triple
+                        line = f"{statement} {graph} .\n" if output_format == 'nq' else f"{statement} .\n"
+                        buffer.append(line)
+                        size += len(line)
+                        quads += 1
+                        if size >= EXPORT_CHUNK_SIZE:
+                            yield ''.join(buffer).encode('utf-8')
+                            buffer = []
+                            size = 0
+            except (SyntaxError, ValueError) as e:
+                # The statements before the error are in the export already
+                logging.error(f"Could not export all of {file_path}: {e}")
+        if output_format == 'trig':
+            buffer.append("}\n")
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+    observe('metamap_export_quads_total', quads, format=output_format)
+
+
+def gzip_chunks(chunks):
+    # Compress a stream of chunks into one gzip member as it goes
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def parse_export_args(args):
+    # (output format, compress, since) from /export's query string
+    output_format = args.get('format', 'nq')
+    if output_format not in ('nq', 'trig'):
+        raise ValueError(f"Exports are N-Quads (nq) or TriG (trig), not {output_format}")
+    since = args.get('since', '0')
+    if since == 'last':
+        since = get_export_watermark(args.get('consumer', 'default'))
+    elif not since.isdigit():
+        raise ValueError(f"since is a catalog id or 'last', not {since}")
+    return output_format, args.get('compress') == 'gzip', int(since)
+
+
+@app.route('/export')
+def export():
+    # Every submission's metadata as one dataset, e.g.
+    # /export?format=trig&compress=gzip&since=last&consumer=graphdb
+    # A completed download moves consumer's watermark to the X-Export-Until id.
+    try:
+        output_format, compress, since = parse_export_args(request.args)
+    except ValueError as e:
+        return str(e), 400
+    consumer = request.args.get('consumer', 'default')
+    since, until = export_range(since)
+
+    def stream():
+        chunks = export_chunks(since, until, output_format)
+        yield from (gzip_chunks(chunks) if compress else chunks)
+        # Only reached when the client read the whole export
+        set_export_watermark(consumer, until)
+
+    download_name = f"metamap_export_{since}_{until}{output_extension(output_format, compress)}"
+    headers = {
+        'Content-Disposition': f'attachment; filename="{download_name}"',
+        'X-Export-Since': str(since),
+        'X-Export-Until': str(until),
+    }
+    mimetype = 'application/gzip' if compress else OUTPUT_FORMATS[output_format][1]
+    return Response(stream(), mimetype=mimetype, headers=headers)
+
+
+@app.cli.command('export')
+@click.argument('filename')
+@click.option('--format', 'output_format', type=click.Choice(['nq', 'trig']), default=None,
+              help="Defaults to the format of FILENAME's extension, else N-Quads.")
+@click.option('--gzip', 'compress', is_flag=True, help="Compress, also implied by a .gz FILENAME.")
+@click.option('--since', default=None, help="Catalog id to export after, or 'last' for the consumer's watermark.")
+@click.option('--consumer', default='default', help="Whose watermark --since last reads and the export moves.")
+def export_command(filename, output_format, compress, since, consumer):
+    """Write the metadata of every submission, or those since the last export, to one N-Quads/TriG file."""
+    compress = compress or filename.endswith('.gz')
+    output_format = output_format or output_format_for_path(filename)[0] or 'nq'
+    if output_format not in ('nq', 'trig'):
+        raise click.BadParameter(f"Exports are N-Quads or TriG, not {output_format}", param_hint='--format')
+    try:
+        output_format, _, since = parse_export_args({'format': output_format, 'since': since or '0',
+                                                     'consumer': consumer})
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--since') from e
+    since, until = export_range(since)
+    with atomic_write(filename, compress) as f:
+        for chunk in export_chunks(since, until, output_format):
+            f.write(chunk)
+    set_export_watermark(consumer, until)
+    if until > since:
+        print(f"Exported submissions {since + 1} to {until} to {filename}")
+    else:
+        print(f"No submissions after {since}, wrote an empty {filename}")
+
+
+def requested_output_format(form_data):
+    # Output format chosen in add_metadata.html, Turtle unless asked otherwise
+    output_format = form_data.get('outputFormat') or 'turtle'
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format}")
+    return output_format, form_data.get('compress') == 'gzip'
+
+
+def output_extension(output_format, compress=False):
+    return OUTPUT_FORMATS[output_format][0] + ('.gz' if compress else '')
+
+
+def output_format_for_path(file_path):
+    # (output format, compressed) for a generated file, from its extension
+    compress = file_path.endswith('.gz')
+    if compress:
+        file_path = file_path[:-len('.gz')]
+    for output_format, (extension, _) in OUTPUT_FORMATS.items():
+        if file_path.endswith(extension):
+            return output_format, compress
+    return None, compress
+
+
+def output_graph_name(file_path):
+    # Named graph for the quad formats, one per generated file
+    name = os.path.basename(file_path)
+    if name.endswith('.gz'):
+        name = name[:-len('.gz')]
+    name = os.path.splitext(name)[0]
+    return URIRef(f"http://example.com/metag/graph/{quote(name)}")
+
+
+def open_output(file_path, compress):
+    if compress:
+        return gzip.open(file_path, 'wb', compresslevel=6)
+    return open(file_path, 'wb')
+
+
+def open_metadata_file(file_path):
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rb')
+    return open(file_path, 'rb')
+
+
+@contextmanager
+def statement_writer(f, output_format, graph_name):
+    # Yields a binary file-like object that takes N-Triples lines and writes
+    # them to f as N-Triples, N-Quads in graph_name, or a TriG graph_name block
+    if output_format == 'trig':
+        f.write(f"{graph_name.n3()} {{\n".encode('utf-8'))
+        yield f
+        f.write(b"}\n")
+    elif output_format == 'nq':
+        writer = NQuadsWriter(f, graph_name)
+        yield writer
+        writer.close()
+    else:
+        yield f
+
+
+def strip_nt_comment(line):
+    # line without its trailing "# comment", leaving any # inside an IRI or a
+    # literal alone
+    if b"#" not in line:
+        return line
+    in_iri = in_literal = escaped = False
+    for index, char in enumerate(line):
+        if in_literal:
+            if escaped:
+                escaped = False
+            elif char == ord('\\'):
+                escaped = True
+            elif char == ord('"'):
+                in_literal = False
+        elif in_iri:
+            in_iri = char != ord('>')
+        elif char == ord('"'):
+            in_literal = True
+        elif char == ord('<'):
+            in_iri = True
+        elif char == ord('#'):
+            return line[:index]
+    return line
+
+
+class NQuadsWriter:
+    # Rewrites "s p o .\n" lines to "s p o g .\n" as they are written.
+    # Comments and blank lines are dropped, anything else that isn't a
+    # statement is an error rather than being skipped.
+    def __init__(self, f, graph_name):
+        self.f = f
+        self.graph_suffix = f" {graph_name.n3()} .\n".encode('utf-8')
+        self.pending = b''
+
+    def write(self, data):
+        lines = (self.pending + data).split(b"\n")
+        self.pending = lines.pop()
+        self.f.write(b''.join(self.quad(line) for line in lines))
+        return len(data)
+
+    def close(self):
+        # The last line may not end in a newline
+        self.f.write(self.quad(self.pending))
+        self.pending = b''
+
+    def quad(self, line):
+        line = strip_nt_comment(line).strip()
+        if not line:
+            return b''
+        if not line.endswith(b"."):
+            raise ValueError(f"Not an N-Triples statement: {line[:200].decode('utf-8', 'replace')}")
+        return line[:-1].rstrip() + self.graph_suffix
+
+
 def populate_named_graph(form_data, g_named_graph):
-    dcmi = Namespace("http://purl.org/dc/terms/")
     subject_uri = URIRef("http://example.com/metag/subject")
-    foaf = Namespace("http://xmlns.com/foaf/0.1/")
-    custom_ns = Namespace("http://example.com/metag/")
-    g_named_graph.bind("metag", custom_ns)
-    g_named_graph.bind("foaf", foaf)
-    g_named_graph.bind("dcmi", dcmi)
-
-    g_named_graph.add(
-        (subject_uri, foaf.givenName, Literal(form_data['fname'])))
-    g_named_graph.add(
-        (subject_uri, foaf.familyName, Literal(form_data['lname'])))
-    g_named_graph.add(
-        (subject_uri, foaf.background, Literal(form_data['background'])))
-    g_named_graph.add((subject_uri, foaf.role, Literal(form_data['role'])))
-    g_named_graph.add(
-        (subject_uri, foaf.organization, Literal(form_data['organization'])))
-
-    g_named_graph.add(
-        (subject_uri, custom_ns.purpose, Literal(form_data['requirement'])))
-    g_named_graph.add((subject_uri, custom_ns.mappingType,
-                       Literal(form_data['mappingType'])))
-    g_named_graph.add((subject_uri, custom_ns.mappingDomain,
-                       Literal(form_data['mappingDomain'])))
-    g_named_graph.add((subject_uri, custom_ns.mappingAssumptions,
-                       Literal(form_data['mappingAssumptions'])))
-    g_named_graph.add((subject_uri, custom_ns.technicalRequirement,
-                       Literal(form_data['technicalRequirement'])))
-    g_named_graph.add((subject_uri, custom_ns.risksIssues,
-                       Literal(form_data['risksIssues'])))
-
-    g_named_graph.add(
-        (subject_uri, dcmi.source, Literal(form_data['InputURI'])))
-    g_named_graph.add(
-        (subject_uri, dcmi.creator, Literal(form_data['InputSource'])))
-
-    g_named_graph.add(
-        (subject_uri, custom_ns.startDate, Literal(form_data['StartDate'])))
-    g_named_graph.add(
-        (subject_uri, custom_ns.endDate, Literal(form_data['EndDate'])))
-    g_named_graph.add(
-        (subject_uri, custom_ns.tool, Literal(form_data['Tool'])))
-    g_named_graph.add((subject_uri, custom_ns.mappingMethod,
-                       Literal(form_data['MappingMethod'])))
-
-    g_named_graph.add(
-        (subject_uri, custom_ns.mappingURI, Literal(form_data['mappingURI'])))
-    g_named_graph.add((subject_uri, custom_ns.mappingName,
-                       Literal(form_data['mappingName'])))
-    g_named_graph.add((subject_uri, custom_ns.mappingAlgorithm,
-                       Literal(form_data['mappingAlgorithm'])))
-    g_named_graph.add((subject_uri, custom_ns.mappingFormat,
-                       Literal(form_data['mappingFormat'])))
-
-    g_named_graph.add(
-        (subject_uri, custom_ns.testingURI, Literal(form_data['testingURI'])))
-    g_named_graph.add((subject_uri, custom_ns.testingName,
-                       Literal(form_data['testingName'])))
-    g_named_graph.add((subject_uri, custom_ns.testingType,
-                       Literal(form_data['testingType'])))
-    g_named_graph.add((subject_uri, custom_ns.testingDate,
-                       Literal(form_data['testingDate'])))
-    g_named_graph.add((subject_uri, custom_ns.testingResult,
-                       Literal(form_data['testingResult'])))
-
-    g_named_graph.add((subject_uri, custom_ns.publisherName,
-                       Literal(form_data['publisherName'])))
-    g_named_graph.add((subject_uri, custom_ns.publisherSource,
-                       Literal(form_data['publisherSource'])))
-    g_named_graph.add((subject_uri, custom_ns.versionNumber,
-                       Literal(form_data['versionNumber'])))
-    g_named_graph.add((subject_uri, custom_ns.versionDateTime,
-                       Literal(form_data['versionDateTime'])))
-
-
-def populate_rdf_star(form_data, g_rdf_star, uploaded_file_name):
-    # Determine if the file should be handled as Ontologies Alignment, Uplift Mapping, or Interlinking
+    g_named_graph.bind("metag", METAG)
+    g_named_graph.bind("foaf", FOAF)
+    g_named_graph.bind("dcmi", DCMI)
+
+    for predicate, value in metadata_values(METADATA_SCHEMA, form_data):
+        g_named_graph.add((subject_uri, predicate, Literal(value)))
+
+
+def populate_rdf_star(form_data, uploaded_file_name, content_hash=None, rdf_format=None, uploaded_file_path=None):
+    # Determine if the file should be handled as Ontologies Alignment, Uplift Mapping, or Interlinking.
+    # rdf_format is the format detected at upload, otherwise it's guessed from the file name.
+    # The file is read from uploaded_file_path (its blob) when given, otherwise
+    # from uploaded_file_name in UPLOAD_FOLDER.
     mapping_type = form_data['mappingType']
+    rdf_format = rdf_format or mapping_rdf_format(uploaded_file_name)
+    uploaded_file_path = uploaded_file_path or os.path.join(app.config['UPLOAD_FOLDER'], uploaded_file_name)
 
     if mapping_type == "Ontologies Alignment":
-        return populate_rdf_star_Ontology(form_data, g_rdf_star, uploaded_file_name)
+        return populate_rdf_star_Ontology(form_data, uploaded_file_name, content_hash, rdf_format, uploaded_file_path)
 
     elif mapping_type == "Uplift Mapping":
-        return populate_rdf_star_Uplift(form_data, g_rdf_star, uploaded_file_name)
+        return populate_rdf_star_Uplift(form_data, uploaded_file_name, content_hash, rdf_format, uploaded_file_path)
 
     elif mapping_type == "Interlinking":
-        return populate_rdf_star_Interlink(form_data, g_rdf_star, uploaded_file_name)
+        return populate_rdf_star_Interlink(form_data, uploaded_file_name, content_hash, rdf_format, uploaded_file_path)
 
 
-def populate_rdf_star_Interlink(form_data, g_rdf_star, uploaded_file_name):
-    # Define namespaces for metadata and interlinking-related properties
-    custom_ns = Namespace("http://example.com/ontology#")
-    dcmi = Namespace("http://purl.org/dc/terms/")
-    ex = Namespace("http://example.com/")
-    xsd = Namespace("http://www.w3.org/2001/XMLSchema#")
+def rdf_star_output_path(uploaded_file_name, output_key, output_format, compress):
+    # Outputs are named after what went into them, so identical submissions
+    # share one file and different ones never overwrite each other
+    rdf_filename_rdf_star = f"{uploaded_file_name}_{output_key[:16]}_rdf_star{output_extension(output_format, compress)}"
+    return os.path.join(app.config['UPLOAD_FOLDER'], rdf_filename_rdf_star)
 
-    # Bind namespaces to the graph (optional but recommended)
-    g_rdf_star.bind("custom", custom_ns)
-    g_rdf_star.bind("dcmi", dcmi)
-    g_rdf_star.bind("ex", ex)
-    g_rdf_star.bind("xsd", xsd)
 
-    # File path for the uploaded file
-    uploaded_file_path = os.path.join(app.config['UPLOAD_FOLDER'], uploaded_file_name)
+def populate_rdf_star_Interlink(form_data, uploaded_file_name, content_hash=None, rdf_format='turtle',
+                                uploaded_file_path=None):
+    # An interlinking operation is either a SPARQL query (.rq), described by
+    # its triple patterns when it parses, or an RDF file of links, included as
+    # it is. The operation and every predicate it links with get the
+    # interlinking metadata as RDF-star annotations.
+    interlink_iri = URIRef(f"http://example.com/interlink/{uploaded_file_name}")
+    output_format, compress = requested_output_format(form_data)
+    annotations = render_annotations(INTERLINK_METADATA_SCHEMA, form_data, output_format)
 
     if uploaded_file_name.endswith('.rq'):
-        # Handle SPARQL files manually as plain text
+        # Handle SPARQL files as plain text
         with open(uploaded_file_path, 'r', encoding='utf-8') as f:
             sparql_query_content = f.read()  # Read the SPARQL content
 
-        # Create an IRI for the interlinking operation based on the file name
-        interlink_iri = URIRef(f"http://example.com/interlink/{uploaded_file_name}")
-
-        # Add SPARQL query content to the RDF-star output
-        rdf_star_output = f"{interlink_iri.n3()} a {custom_ns.SPARQLQuery.n3()} ;\n"
-        rdf_star_output += f"    {ex.queryContent.n3()} {Literal(sparql_query_content).n3()} .\n\n"
-
-        # Metadata from the form
-        fname = form_data.get('fname')
-        lname = form_data.get('lname')
-        background = form_data.get('background')
-        role = form_data.get('role')
-        organization = form_data.get('organization')
-        requirement = form_data.get('requirement')
-        mappingType = form_data.get('mappingType')
-        mappingDomain = form_data.get('mappingDomain')
-        mappingAssumptions = form_data.get('mappingAssumptions')
-        technicalRequirement = form_data.get('technicalRequirement')
-        risksIssues = form_data.get('risksIssues')
-        inputURI = form_data.get('InputURI')
-        inputSource = form_data.get('InputSource')
-        startDate = form_data.get('StartDate')
-        endDate = form_data.get('EndDate')
-        tool = form_data.get('Tool')
-        mappingMethod = form_data.get('MappingMethod')
-        mappingURI = form_data.get('mappingURI')
-        mappingName = form_data.get('mappingName')
-        mappingAlgorithm = form_data.get('mappingAlgorithm')
-        mappingFormat = form_data.get('mappingFormat')
-        testingURI = form_data.get('testingURI')
-        testingName = form_data.get('testingName')
-        testingType = form_data.get('testingType')
-        testingDate = form_data.get('testingDate')
-        testingResult = form_data.get('testingResult')
-        publisherName = form_data.get('publisherName')
-        publisherSource = form_data.get('publisherSource')
-        versionNumber = form_data.get('versionNumber')
-        versionDateTime = form_data.get('versionDateTime')
-
-        # Annotate the SPARQL query with RDF-star
-        rdf_star_output += f"<< {interlink_iri.n3()} {RDF.type.n3()} {custom_ns.InterlinkingOperation.n3()} >>\n"
-        rdf_star_output += f"    {dcmi.creator.n3()} {Literal(f'{fname} {lname}').n3()} ;\n"
-        rdf_star_output += f"    {dcmi.purpose.n3()} {Literal(requirement).n3()} ;\n"
-        rdf_star_output += f"    {ex.toolUsed.n3()} {Literal(tool).n3()} ;\n"
-        rdf_star_output += f"    {dcmi.created.n3()} {Literal(startDate).n3()}^^xsd:date ;\n"
-        rdf_star_output += f"    {ex.mappingMethod.n3()} {Literal(mappingMethod).n3()} ;\n"
-        rdf_star_output += f"    {ex.mappingDomain.n3()} {Literal(mappingDomain).n3()} ;\n"
-        rdf_star_output += f"    {ex.mappingURI.n3()} {Literal(mappingURI).n3()} ;\n"
-        rdf_star_output += f"    {ex.mappingName.n3()} {Literal(mappingName).n3()} ;\n"
-        rdf_star_output += f"    {ex.mappingAlgorithm.n3()} {Literal(mappingAlgorithm).n3()} ;\n"
-        rdf_star_output += f"    {ex.mappingFormat.n3()} {Literal(mappingFormat).n3()} ;\n"
-        rdf_star_output += f"    {ex.testingURI.n3()} {Literal(testingURI).n3()} ;\n"
-        rdf_star_output += f"    {ex.testingName.n3()} {Literal(testingName).n3()} ;\n"
-        rdf_star_output += f"    {ex.testingType.n3()} {Literal(testingType).n3()} ;\n"
-        rdf_star_output += f"    {ex.testingDate.n3()} {Literal(testingDate).n3()}^^xsd:date ;\n"
-        rdf_star_output += f"    {ex.testingResult.n3()} {Literal(testingResult).n3()} ;\n"
-        rdf_star_output += f"    {ex.publisherName.n3()} {Literal(publisherName).n3()} ;\n"
-        rdf_star_output += f"    {ex.publisherSource.n3()} {Literal(publisherSource).n3()} ;\n"
-        rdf_star_output += f"    {ex.versionNumber.n3()} {Literal(versionNumber).n3()} ;\n"
-        rdf_star_output += f"    {ex.versionDateTime.n3()} {Literal(versionDateTime).n3()}^^xsd:dateTime .\n\n"
-
-        # Save RDF-star file
-        rdf_filename_rdf_star = f"{uploaded_file_name}_rdf_star.ttl"
-        rdf_star_file_path = os.path.join(app.config['UPLOAD_FOLDER'], rdf_filename_rdf_star)
-
-        with open(rdf_star_file_path, "w", encoding='utf-8') as file_rdf_star:
-            file_rdf_star.write(rdf_star_output)
-
-        logging.debug(f"RDF-star file saved at: {rdf_star_file_path}")
+        if output_format == 'turtle':
+            # Add SPARQL query content to the RDF-star output
+            rdf_star_output = f"{interlink_iri.n3()} a {ONTOLOGY.SPARQLQuery.n3()} ;\n"
+            rdf_star_output += f"    {EX.queryContent.n3()} {Literal(sparql_query_content).n3()} .\n\n"
+        else:
+            rdf_star_output = f"{interlink_iri.n3()} {RDF.type.n3()} {ONTOLOGY.SPARQLQuery.n3()} .\n"
+            rdf_star_output += f"{interlink_iri.n3()} {EX.queryContent.n3()} {nt_literal(sparql_query_content)} .\n"
+
+        analysis = analyze_interlink_query(sparql_query_content)
+        if analysis is not None:
+            rdf_star_output += interlink_query_statements(interlink_iri, analysis)
+            if output_format == 'turtle':
+                rdf_star_output += "\n"
+        link_predicates = analysis['link_predicates'] if analysis else []
+    else:
+        # An RDF file of links, e.g. owl:sameAs statements
+        g = load_mapping_graph(uploaded_file_path, rdf_format, content_hash)
+        body_format = 'turtle' if output_format == 'turtle' else 'nt'
+        rdf_star_output = g.serialize(format=body_format)
+        if not rdf_star_output.endswith("\n"):
+            rdf_star_output += "\n"
+        link_predicates = sorted({predicate.n3() for _, predicate, o in g
+                                  if predicate != RDF.type and isinstance(o, URIRef)})
+        rdf_star_output += ''.join(f"{interlink_iri.n3()} {EX.linkPredicate.n3()} {predicate} .\n"
+                                   for predicate in link_predicates)
+        if output_format == 'turtle':
+            rdf_star_output += "\n"
+
+    # Annotate the interlinking operation and its link predicates with RDF-star
+    quoted_triples = [f"<< {interlink_iri.n3()} {RDF.type.n3()} {ONTOLOGY.InterlinkingOperation.n3()} >>"]
+    quoted_triples += [f"<< {interlink_iri.n3()} {EX.linkPredicate.n3()} {predicate} >>" for predicate in link_predicates]
+    for quoted_triple in quoted_triples:
+        if output_format == 'turtle':
+            rdf_star_output += f"{quoted_triple}\n"
+            rdf_star_output += render_annotation_block(annotations)
+        else:
+            rdf_star_output += ''.join(f"{quoted_triple} {annotation} .\n" for annotation in annotations)
 
-        return rdf_star_file_path
+    # Save RDF-star file
+    rdf_star_output = rdf_star_output.encode('utf-8')
+    output_key = hashlib.sha256(rdf_star_output).hexdigest()
+    rdf_star_file_path = rdf_star_output_path(uploaded_file_name, output_key, output_format, compress)
 
-    else:
-        # Handle RDF file parsing and annotation as before (non-SPARQL files)
-        try:
-            g_rdf_star.parse(uploaded_file_path, format='turtle', publicID=None)
-        except Exception as e:
-            logging.error(f"Failed to parse RDF file {uploaded_file_path}: {e}")
-            raise e
+    if not os.path.exists(rdf_star_file_path):
+        with (atomic_write(rdf_star_file_path, compress) as file_rdf_star,
+              statement_writer(file_rdf_star, output_format, output_graph_name(rdf_star_file_path)) as out):
+            out.write(rdf_star_output)
 
+    logging.debug(f"RDF-star file saved at: {rdf_star_file_path}")
 
+    return rdf_star_file_path
+
+
+def analyze_interlink_query(query):
+    # The structure of an interlinking query (see parse_interlink_query), or
+    # None when it doesn't parse
+    analysis = interlink_query_analysis(query)
+    return None if 'error' in analysis else analysis
+
+
+def interlink_query_analysis(query):
+    # parse_interlink_query's result, cached by the hash of the normalized
+    # query in memory and in SERIALIZATION_CACHE_FOLDER, so a query template
+    # is parsed once however often it's uploaded. Comments are left out of the
+    # key, which is safe since they never change the analysis.
+    key = hashlib.sha256(f"{QUERY_ANALYSIS_KEY_VERSION}\n{normalize_sparql_query(query)}".encode('utf-8')).hexdigest()
+    with query_analysis_lock:
+        analysis = query_analysis_cache.get(key)
+        if analysis is not None:
+            query_analysis_cache.move_to_end(key)
+
+    if analysis is None:
+        cache_folder = os.path.join(app.config['UPLOAD_FOLDER'], SERIALIZATION_CACHE_FOLDER)
+        cache_path = os.path.join(cache_folder, f"{key}.query.json")
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                analysis = json.load(f)
+            os.utime(cache_path)
+        else:
+            with timed_stage('query_analysis'):
+                analysis = parse_interlink_query(query)
+            os.makedirs(cache_folder, exist_ok=True)
+            with atomic_write(cache_path) as f:
+                f.write(json.dumps(analysis).encode('utf-8'))
+        with query_analysis_lock:
+            query_analysis_cache[key] = analysis
+            while len(query_analysis_cache) > QUERY_ANALYSIS_CACHE_SIZE:
+                query_analysis_cache.popitem(last=False)
+
+    return analysis
+
+
+def parse_interlink_query(query):
+    # Parse a SPARQL query or update into algebra and return, as JSON:
+    #   form: the algebra name of each operation, e.g. ConstructQuery or Modify
+    #   templates: the triple patterns it creates (CONSTRUCT/INSERT), i.e. the links
+    #   patterns: the triple patterns it matches (WHERE)
+    #   link_predicates: the N3 of the IRI predicates in templates
+    # Each triple pattern is {'triple': [subject, predicate, object], 'graph': term or None}
+    # with terms as pattern_term() pairs. An unparseable query gives {'error': message}.
+    from rdflib.plugins.sparql.algebra import translateQuery, translateUpdate
+    from rdflib.plugins.sparql.parser import parseQuery, parseUpdate
+
+    try:
+        operations = [translateQuery(parseQuery(query)).algebra]
+    except Exception as query_error:
+        try:
+            operations = translateUpdate(parseUpdate(query)).algebra
+        except Exception as update_error:
+            if isinstance(query_error, RecursionError) or isinstance(update_error, RecursionError):
+                # rdflib's recursive descent parser runs out of stack on a
+                # group of several hundred triple patterns, valid or not
+                logging.debug("Interlinking query too large to analyse")
+                return {'error': "the query has too many triple patterns for the SPARQL parser to analyse"}
+            # Report whichever got further, errors after parsing (e.g. an
+            # undefined prefix) being furthest of all
+            error = max((query_error, update_error), key=lambda e: getattr(e, 'loc', float('inf')))
+            logging.debug(f"Could not parse interlinking query: {error}")
+            return {'error': str(error)}
+
+    # Algebra nodes return None for missing clauses
+    templates = []
+    patterns = []
+    for operation in operations:
+        if operation.name not in ('DeleteData', 'DeleteWhere'):
+            for clause in ('template', 'insert', 'triples', 'quads'):
+                templates.extend(template_patterns(getattr(operation, clause)))
+        if operation.name == 'ConstructQuery' and not operation.template:
+            # CONSTRUCT WHERE { ... } creates what it matches
+            templates.extend(algebra_patterns(operation.p))
+        for clause in ('p', 'where'):
+            patterns.extend(algebra_patterns(getattr(operation, clause)))
+
+    link_predicates = []
+    for pattern in templates:
+        kind, predicate = pattern['triple'][1]
+        if kind == 'term' and predicate.startswith('<') and predicate not in link_predicates:
+            link_predicates.append(predicate)
+
+    return {
+        'form': [operation.name for operation in operations],
+        'templates': templates,
+        'patterns': patterns,
+        'link_predicates': link_predicates,
+    }
+
+
+def template_patterns(template, graph=None):
+    # Triple patterns of a CONSTRUCT template or INSERT/DELETE clause, whose
+    # triples may also be grouped by graph under 'quads'
+    from rdflib.plugins.sparql.parserutils import CompValue
+
+    if isinstance(template, CompValue):
+        yield from template_patterns(template.triples, graph)
+        yield from template_patterns(template.quads, graph)
+    elif isinstance(template, dict):
+        for quad_graph, triples in template.items():
+            yield from template_patterns(triples, quad_graph)
+    elif template:
+        for triple in template:
+            yield triple_pattern(triple, graph)
+
+
+def algebra_patterns(node, graph=None):
+    # Triple patterns of every basic graph pattern under an algebra node,
+    # with the GRAPH they are matched in
+    from rdflib.plugins.sparql.parserutils import CompValue
+
+    if isinstance(node, CompValue):
+        if node.name == 'BGP':
+            for triple in node.triples:
+                yield triple_pattern(triple, graph)
+        elif node.name == 'TriplesBlock':
+            # Left untranslated inside EXISTS, as flat s p o s p o ... lists
+            for block in node.triples:
+                for index in range(0, len(block), 3):
+                    yield triple_pattern(block[index:index + 3], graph)
+        elif node.name == 'Graph':
+            yield from algebra_patterns(node.p, node.term)
+        else:
+            for value in node.values():
+                yield from algebra_patterns(value, graph)
+    elif isinstance(node, list):
+        for value in node:
+            yield from algebra_patterns(value, graph)
+
+
+def triple_pattern(triple, graph):
+    return {'triple': [pattern_term(term) for term in triple],
+            'graph': pattern_term(graph) if graph is not None else None}
+
+
+def pattern_term(term):
+    # (kind, value): a variable name, a property path in SPARQL syntax, or the
+    # N-Triples form of an IRI or literal
+    if isinstance(term, (Variable, BNode)):
+        return 'var', str(term)
+    if isinstance(term, Path):
+        return 'path', term.n3()
+    if isinstance(term, Literal):
+        if term.language:
+            return 'term', f"{nt_literal(term)}@{term.language}"
+        if term.datatype:
+            return 'term', f"{nt_literal(term)}^^{term.datatype.n3()}"
+        return 'term', nt_literal(term)
+    return 'term', term.n3()
+
+
+def interlink_query_statements(interlink_iri, analysis):
+    # N-Triples lines (so also valid Turtle) describing an analysed query: its
+    # link predicates, and each template (ex:linkPattern) and WHERE
+    # (ex:graphPattern) triple pattern as an ex:TriplePattern resource
+    lines = [f"{interlink_iri.n3()} {EX.queryForm.n3()} {nt_literal(form)} ." for form in analysis['form']]
+    lines += [f"{interlink_iri.n3()} {EX.linkPredicate.n3()} {predicate} ." for predicate in analysis['link_predicates']]
+    for link, patterns in ((EX.linkPattern, analysis['templates']), (EX.graphPattern, analysis['patterns'])):
+        role = 'link' if link == EX.linkPattern else 'pattern'
+        for index, pattern in enumerate(patterns, 1):
+            node = URIRef(f"{interlink_iri}/{role}/{index}").n3()
+            lines.append(f"{interlink_iri.n3()} {link.n3()} {node} .")
+            lines.append(f"{node} {RDF.type.n3()} {EX.TriplePattern.n3()} .")
+            positions = zip(('subject', 'predicate', 'object', 'graph'), pattern['triple'] + [pattern['graph']], strict=True)
+            for position, term in positions:
+                if term is None:
+                    continue
+                kind, value = term
+                if kind == 'var':
+                    lines.append(f"{node} {EX[position + 'Variable'].n3()} {nt_literal(value)} .")
+                elif kind == 'path':
+                    lines.append(f"{node} {EX[position + 'Path'].n3()} {nt_literal(value)} .")
+                else:
+                    lines.append(f"{node} {EX[position].n3()} {value} .")
+    return ''.join(f"{line}\n" for line in lines)
 
 
     
-def populate_rdf_star_Ontology(form_data, g_rdf_star, uploaded_file_name):
-    # Parse the ontology alignment file (EDOL alignment file)
-    uploaded_file_path = os.path.join(app.config['UPLOAD_FOLDER'], uploaded_file_name)
-    g_rdf_star.parse(uploaded_file_path, format='turtle', publicID=None)
-
-    # Define namespaces for metadata and alignment-related namespaces
-    foaf = Namespace("http://xmlns.com/foaf/0.1/")
-    custom_ns = Namespace("http://example.com/metag/")
-    align = Namespace("http://knowledgeweb.semanticweb.org/heterogeneity/alignment#")
-    dcmi = Namespace("http://purl.org/dc/terms/")
-
-    # Metadata from the form
-    fname = form_data.get('fname')
-    lname = form_data.get('lname')
-    background = form_data.get('background')
-    role = form_data.get('role')
-    organization = form_data.get('organization')
-
-    requirement = form_data.get('requirement')
-    mappingType = form_data.get('mappingType')
-    mappingDomain = form_data.get('mappingDomain')
-    mappingAssumptions = form_data.get('mappingAssumptions')
-    technicalRequirement = form_data.get('technicalRequirement')
-    risksIssues = form_data.get('risksIssues')
-
-    inputURI = form_data.get('InputURI')
-    inputSource = form_data.get('InputSource')
-    startDate = form_data.get('StartDate')
-    endDate = form_data.get('EndDate')
-    tool = form_data.get('Tool')
-    mappingMethod = form_data.get('MappingMethod')
-
-    mappingURI = form_data.get('mappingURI')
-    mappingName = form_data.get('mappingName')
-    mappingAlgorithm = form_data.get('mappingAlgorithm')
-    mappingFormat = form_data.get('mappingFormat')
-
-    testingURI = form_data.get('testingURI')
-    testingName = form_data.get('testingName')
-    testingType = form_data.get('testingType')
-    testingDate = form_data.get('testingDate')
-    testingResult = form_data.get('testingResult')
-
-    publisherName = form_data.get('publisherName')
-    publisherSource = form_data.get('publisherSource')
-    versionNumber = form_data.get('versionNumber')
-    versionDateTime = form_data.get('versionDateTime')
-
-    # Manual RDF-star triples for ontology alignment as output
-    rdf_star_output = ""
-
-    # Find the alignment subject and annotate it
-    for alignment in g_rdf_star.subjects(RDF.type, align.Alignment):
-        # Manually construct RDF-star triples in Turtle format for the whole alignment
-        rdf_star_output += f"<< {alignment.n3()} {RDF.type.n3()} {align.Alignment.n3()} >>\n"
-        rdf_star_output += f"    {foaf.givenName.n3()} {Literal(fname).n3()} ;\n"
-        rdf_star_output += f"    {foaf.familyName.n3()} {Literal(lname).n3()} ;\n"
-        rdf_star_output += f"    {foaf.background.n3()} {Literal(background).n3()} ;\n"
-        rdf_star_output += f"    {foaf.role.n3()} {Literal(role).n3()} ;\n"
-        rdf_star_output += f"    {foaf.organization.n3()} {Literal(organization).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.purpose.n3()} {Literal(requirement).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingType.n3()} {Literal(mappingType).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingDomain.n3()} {Literal(mappingDomain).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingAssumptions.n3()} {Literal(mappingAssumptions).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.technicalRequirement.n3()} {Literal(technicalRequirement).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.risksIssues.n3()} {Literal(risksIssues).n3()} ;\n"
-        rdf_star_output += f"    {dcmi.source.n3()} {Literal(inputURI).n3()} ;\n"
-        rdf_star_output += f"    {dcmi.creator.n3()} {Literal(inputSource).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.startDate.n3()} {Literal(startDate).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.endDate.n3()} {Literal(endDate).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.tool.n3()} {Literal(tool).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingMethod.n3()} {Literal(mappingMethod).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingURI.n3()} {Literal(mappingURI).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingName.n3()} {Literal(mappingName).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingAlgorithm.n3()} {Literal(mappingAlgorithm).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingFormat.n3()} {Literal(mappingFormat).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.testingURI.n3()} {Literal(testingURI).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.testingName.n3()} {Literal(testingName).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.testingType.n3()} {Literal(testingType).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.testingDate.n3()} {Literal(testingDate).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.testingResult.n3()} {Literal(testingResult).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.publisherName.n3()} {Literal(publisherName).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.publisherSource.n3()} {Literal(publisherSource).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.versionNumber.n3()} {Literal(versionNumber).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.versionDateTime.n3()} {Literal(versionDateTime).n3()} .\n\n"
-
-    # Serialize the RDF-star graph to Turtle format and append the manual RDF-star triples
-    rdf_data_rdf_star = g_rdf_star.serialize(format='turtle')
-    rdf_data_rdf_star += rdf_star_output  # Append the manually constructed RDF-star triples
-
-    rdf_filename_rdf_star = f"{uploaded_file_name}_rdf_star.ttl"
-    rdf_star_file_path = os.path.join(app.config['UPLOAD_FOLDER'], rdf_filename_rdf_star)
-
-    with open(rdf_star_file_path, "w") as file_rdf_star:
-        file_rdf_star.write(rdf_data_rdf_star)
+def populate_rdf_star_Ontology(form_data, uploaded_file_name, content_hash=None, rdf_format='turtle',
+                             uploaded_file_path=None):
+    # The ontology alignment file (EDOL alignment file) is only parsed if it
+    # hasn't been serialized before
+
+    # The annotation is the same for every alignment, so render it once
+    output_format, compress = requested_output_format(form_data)
+    annotations = render_annotations(METADATA_SCHEMA, form_data, output_format)
+
+    # Write the alignment file followed by an RDF-star annotation for each alignment
+    rdf_star_file_path = write_rdf_star_annotations(uploaded_file_name, uploaded_file_path, content_hash, ALIGN.Alignment,
+                                                    annotations, output_format, rdf_format, compress)
 
     logging.debug(f"RDF-star file saved at: {rdf_star_file_path}")
 
     return rdf_star_file_path
 
     
-def populate_rdf_star_Uplift(form_data, g_rdf_star, uploaded_file_name):
-    # Load the RML mapping file (your mapping file)
-    uploaded_file_path = os.path.join(app.config['UPLOAD_FOLDER'], uploaded_file_name)
-    g_rdf_star.parse(uploaded_file_path, format='turtle', publicID=None)
-
-    # Define namespaces for metadata and the RML/RR namespaces
-    foaf = Namespace("http://xmlns.com/foaf/0.1/")
-    custom_ns = Namespace("http://example.com/metag/")
-    dcmi = Namespace("http://purl.org/dc/terms/")
-    rr = Namespace("http://www.w3.org/ns/r2rml#")
-
-    # Metadata from the form
-    fname = form_data.get('fname')
-    lname = form_data.get('lname')
-    background = form_data.get('background')
-    role = form_data.get('role')
-    organization = form_data.get('organization')
-
-    requirement = form_data.get('requirement')
-    mappingType = form_data.get('mappingType')
-    mappingDomain = form_data.get('mappingDomain')
-    mappingAssumptions = form_data.get('mappingAssumptions')
-    technicalRequirement = form_data.get('technicalRequirement')
-    risksIssues = form_data.get('risksIssues')
-
-    inputURI = form_data.get('InputURI')
-    inputSource = form_data.get('InputSource')
-    startDate = form_data.get('StartDate')
-    endDate = form_data.get('EndDate')
-    tool = form_data.get('Tool')
-    mappingMethod = form_data.get('MappingMethod')
-
-    mappingURI = form_data.get('mappingURI')
-    mappingName = form_data.get('mappingName')
-    mappingAlgorithm = form_data.get('mappingAlgorithm')
-    mappingFormat = form_data.get('mappingFormat')
-
-    testingURI = form_data.get('testingURI')
-    testingName = form_data.get('testingName')
-    testingType = form_data.get('testingType')
-    testingDate = form_data.get('testingDate')
-    testingResult = form_data.get('testingResult')
-
-    publisherName = form_data.get('publisherName')
-    publisherSource = form_data.get('publisherSource')
-    versionNumber = form_data.get('versionNumber')
-    versionDateTime = form_data.get('versionDateTime')
-
-    # Manual RDF-star triples as output
-    rdf_star_output = ""
-
-    # Iterate through the TriplesMap subjects in the RML file and annotate them
-    for tm in g_rdf_star.subjects(RDF.type, rr.TriplesMap):
-        # Manually construct RDF-star triples in Turtle format
-        rdf_star_output += f"<< {tm.n3()} {RDF.type.n3()} {rr.TriplesMap.n3()} >>\n"
-        rdf_star_output += f"    {foaf.givenName.n3()} {Literal(fname).n3()} ;\n"
-        rdf_star_output += f"    {foaf.familyName.n3()} {Literal(lname).n3()} ;\n"
-        rdf_star_output += f"    {foaf.background.n3()} {Literal(background).n3()} ;\n"
-        rdf_star_output += f"    {foaf.role.n3()} {Literal(role).n3()} ;\n"
-        rdf_star_output += f"    {foaf.organization.n3()} {Literal(organization).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.purpose.n3()} {Literal(requirement).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingType.n3()} {Literal(mappingType).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingDomain.n3()} {Literal(mappingDomain).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingAssumptions.n3()} {Literal(mappingAssumptions).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.technicalRequirement.n3()} {Literal(technicalRequirement).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.risksIssues.n3()} {Literal(risksIssues).n3()} ;\n"
-        rdf_star_output += f"    {dcmi.source.n3()} {Literal(inputURI).n3()} ;\n"
-        rdf_star_output += f"    {dcmi.creator.n3()} {Literal(inputSource).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.startDate.n3()} {Literal(startDate).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.endDate.n3()} {Literal(endDate).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.tool.n3()} {Literal(tool).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingMethod.n3()} {Literal(mappingMethod).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingURI.n3()} {Literal(mappingURI).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingName.n3()} {Literal(mappingName).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingAlgorithm.n3()} {Literal(mappingAlgorithm).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.mappingFormat.n3()} {Literal(mappingFormat).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.testingURI.n3()} {Literal(testingURI).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.testingName.n3()} {Literal(testingName).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.testingType.n3()} {Literal(testingType).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.testingDate.n3()} {Literal(testingDate).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.testingResult.n3()} {Literal(testingResult).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.publisherName.n3()} {Literal(publisherName).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.publisherSource.n3()} {Literal(publisherSource).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.versionNumber.n3()} {Literal(versionNumber).n3()} ;\n"
-        rdf_star_output += f"    {custom_ns.versionDateTime.n3()} {Literal(versionDateTime).n3()} .\n\n"
-
-    # Serialize the RDF-star graph to Turtle format and append the manual RDF-star triples
-    rdf_data_rdf_star = g_rdf_star.serialize(format='turtle')
-    rdf_data_rdf_star += rdf_star_output  # Append the manually constructed RDF-star triples
-
-    rdf_filename_rdf_star = f"{uploaded_file_name}_rdf_star.ttl"
-    rdf_star_file_path = os.path.join(app.config['UPLOAD_FOLDER'], rdf_filename_rdf_star)
-
-    with open(rdf_star_file_path, "w") as file_rdf_star:
-        file_rdf_star.write(rdf_data_rdf_star)
+def populate_rdf_star_Uplift(form_data, uploaded_file_name, content_hash=None, rdf_format='turtle',
+                           uploaded_file_path=None):
+    # The RML mapping file (your mapping file) is only parsed if it hasn't
+    # been serialized before
+
+    # The annotation is the same for every TriplesMap, so render it once
+    output_format, compress = requested_output_format(form_data)
+    annotations = render_annotations(METADATA_SCHEMA, form_data, output_format)
+
+    # Write the mapping followed by an RDF-star annotation for each TriplesMap
+    rdf_star_file_path = write_rdf_star_annotations(uploaded_file_name, uploaded_file_path, content_hash, RR.TriplesMap,
+                                                    annotations, output_format, rdf_format, compress)
 
     logging.debug(f"RDF-star file saved at: {rdf_star_file_path}")
 
     return rdf_star_file_path
 
+
+def write_rdf_star_annotations(uploaded_file_name, uploaded_file_path, content_hash, rdf_class,
+                               annotations, output_format='turtle', rdf_format='turtle', compress=False):
+    # Write the serialized mapping followed by an RDF-star annotation of
+    # << s rdf:type class >> for each subject of that class, and return the
+    # output path. The serialized mapping and its subjects are cached by
+    # content hash, so resubmitting the same mapping with new metadata only
+    # re-emits the annotations, and an unchanged resubmission reuses the
+    # existing output.
+    if content_hash is None:
+        content_hash = file_content_hash(uploaded_file_path)
+    annotation_text = "\n".join(annotations)
+    # Turtle gets the pretty-printed mapping, every other format is built from N-Triples lines
+    body_format = 'turtle' if output_format == 'turtle' else 'nt'
+    # N-Triples is valid Turtle too, so it can go into either body
+    scannable = app.config['SCAN_MAPPING_SUBJECTS'] and rdf_format in (body_format, 'nt')
+    output_key = hashlib.sha256(f"{content_hash}\n{rdf_class}\n{output_format}\n{scannable}\n{annotation_text}".encode('utf-8')).hexdigest()
+    rdf_star_file_path = rdf_star_output_path(uploaded_file_name, output_key, output_format, compress)
+    if os.path.exists(rdf_star_file_path):
+        logging.debug(f"RDF-star file {rdf_star_file_path} is already up to date")
+        return rdf_star_file_path
+
+    body_path, subjects_path = serialized_mapping_paths(content_hash, rdf_class, body_format)
+    scanned_path = f"{subjects_path}.scanned"
+    unscannable_path = f"{subjects_path}.unscannable"
+    if scannable and not (os.path.exists(scanned_path) or os.path.exists(unscannable_path)):
+        with timed_stage('scan', format=rdf_format):
+            subjects = scan_typed_subjects(uploaded_file_path, rdf_format, rdf_class)
+        with atomic_write(unscannable_path if subjects is None else scanned_path) as subjects_file:
+            for subject in subjects or ():
+                subjects_file.write(f"{subject}\n".encode('utf-8'))
+
+    if scannable and os.path.exists(scanned_path):
+        # The upload itself is the body, only its subjects come from the cache
+        body_path, subjects_path = uploaded_file_path, scanned_path
+    elif not (os.path.exists(body_path) and os.path.exists(subjects_path)):
+        g = load_mapping_graph(uploaded_file_path, rdf_format, content_hash)
+        with timed_stage('serialize', format=body_format), atomic_write(body_path) as body_file:
+            g.serialize(destination=body_file, format=body_format, encoding='utf-8')
+        with atomic_write(subjects_path) as subjects_file:
+            for subject in g.subjects(RDF.type, rdf_class):
+                subjects_file.write(f"{subject.n3()}\n".encode('utf-8'))
+
+    quoted_suffix = f" {RDF.type.n3()} {rdf_class.n3()} >>"
+    if output_format == 'turtle':
+        annotation_suffix = f"{quoted_suffix}\n{render_annotation_block(annotations)}".encode('utf-8')
+    else:
+        annotation_lines = [f"{quoted_suffix} {annotation} .\n".encode('utf-8') for annotation in annotations]
+
+    with (timed_stage('rdf_star_write', format=output_format),
+          atomic_write(rdf_star_file_path, compress) as file_rdf_star,
+          statement_writer(file_rdf_star, output_format, output_graph_name(rdf_star_file_path)) as out):
+        with open(body_path, 'rb') as body_file:
+            shutil.copyfileobj(body_file, out, UPLOAD_CHUNK_SIZE)
+            if body_file.tell() and not ends_with_newline(body_file):
+                out.write(b"\n")
+        with open(subjects_path, 'rb') as subjects_file:
+            for subject in subjects_file:
+                subject = b"<< " + subject.rstrip(b"\n")
+                if output_format == 'turtle':
+                    out.write(subject + annotation_suffix)
+                else:
+                    out.write(b''.join(subject + line for line in annotation_lines))
+    os.utime(subjects_path if body_path == uploaded_file_path else body_path)
+    observe('metamap_output_bytes_total', os.path.getsize(rdf_star_file_path), output='rdf_star')
+    return rdf_star_file_path
+
+
+def scan_typed_subjects(file_path, rdf_format, rdf_class):
+    # Stream file_path with pyoxigraph and return the N3 form of each subject
+    # typed rdf_class, keeping nothing else in memory. Returns None when the
+    # file can't be annotated as it is: oxigraph rejects it (rdflib is more
+    # lenient) or a typed subject is a blank node, whose label the parser
+    # doesn't keep.
+    import pyoxigraph
+    type_predicate = pyoxigraph.NamedNode(str(RDF.type))
+    type_object = pyoxigraph.NamedNode(str(rdf_class))
+    subjects = {}
+    try:
+        with open(file_path, 'rb') as f:
+            for triple in pyoxigraph.parse(f, SCANNABLE_FORMATS[rdf_format]):
+                if triple.predicate != type_predicate or triple.object != type_object:
+                    continue
+                if isinstance(triple.subject, pyoxigraph.BlankNode):
+                    logging.debug(f"Not scanning {file_path}: blank node {rdf_class} subject")
+                    return None
+                subjects[str(triple.subject)] = None
+    except (SyntaxError, ValueError) as e:
+        logging.debug(f"Not scanning {file_path}: {e}")
+        return None
+    return list(subjects)
+
+
+def scan_mapping_file(file_path, rdf_format):
+    # Stream file_path and return (triples, TriplesMaps) for Ack.html and its
+    # validation (see check_mapping_statements), or None when oxigraph rejects it
+    import pyoxigraph
+    try:
+        with open(file_path, 'rb') as f:
+            statements = ((str(t.subject), str(t.predicate), str(t.object))
+                          for t in pyoxigraph.parse(f, SCANNABLE_FORMATS[rdf_format]))
+            counts, validation = check_mapping_statements(statements)
+    except (SyntaxError, ValueError) as e:
+        logging.debug(f"Not scanning {file_path}: {e}")
+        return None
+    observe('metamap_triples_parsed_total', counts[0], format=rdf_format)
+    return counts, validation
+
+
+def check_mapping_statements(statements):
+    # Check (subject, predicate, object) N-Triples strings against
+    # MAPPING_SHAPES in one pass, keeping only what the shapes look at for
+    # each subject. Returns ((triples, TriplesMaps), (mapping types found,
+    # {mapping type: violations})).
+    type_predicate = RDF.type.n3()
+    triples_map = RR.TriplesMap.n3()
+    triple_count = triples_map_count = 0
+    # subject -> [target classes and predicates, Counter of constrained predicates]
+    subjects = {}
+    for subject, predicate, obj in statements:
+        triple_count += 1
+        if predicate == type_predicate:
+            if obj == triples_map:
+                triples_map_count += 1
+            if obj in SHAPE_CLASSES:
+                subjects.setdefault(subject, [set(), Counter()])[0].add(obj)
+        if predicate in SHAPE_TARGET_PREDICATES:
+            subjects.setdefault(obj, [set(), Counter()])[0].add(predicate)
+        if predicate in SHAPE_PREDICATES:
+            subjects.setdefault(subject, [set(), Counter()])[1][predicate] += 1
+
+    found = set().union(*(targets for targets, _ in subjects.values()))
+    mapping_types = [mapping_type for mapping_type, rdf_class in MAPPING_TYPE_CLASSES.items()
+                     if rdf_class.n3() in found]
+    violations = {}
+    for mapping_type, shapes in COMPILED_MAPPING_SHAPES.items():
+        messages = []
+        rdf_class = MAPPING_TYPE_CLASSES.get(mapping_type)
+        if rdf_class is not None and rdf_class.n3() not in found:
+            messages.append(f"There is no {rdf_class.n3()}")
+        for subject, (targets, counts) in subjects.items():
+            for name, shape_class, target_predicate, constraints in shapes:
+                if shape_class not in targets and target_predicate not in targets:
+                    continue
+                for alternatives, min_count, max_count, message in constraints:
+                    count = sum(counts[p] for p in alternatives)
+                    if count < min_count or (max_count is not None and count > max_count):
+                        messages.append(f"{name} {subject} {message}")
+        violations[mapping_type] = messages
+    return (triple_count, triples_map_count), (mapping_types, violations)
+
+
+def check_mapping_graph(g):
+    # check_mapping_statements for a mapping oxigraph can't stream
+    return check_mapping_statements((s.n3(), p.n3(), o.n3()) for s, p, o in g)
+
+
+def ends_with_newline(f):
+    f.seek(-1, os.SEEK_END)
+    return f.read(1) == b"\n"
+
+
+def serialized_mapping_paths(content_hash, rdf_class, body_format='turtle'):
+    cache_folder = os.path.join(app.config['UPLOAD_FOLDER'], SERIALIZATION_CACHE_FOLDER)
+    os.makedirs(cache_folder, exist_ok=True)
+    class_key = hashlib.sha256(str(rdf_class).encode('utf-8')).hexdigest()[:16]
+    body_name = f"{content_hash}.body" if body_format == 'turtle' else f"{content_hash}.{body_format}.body"
+    return (os.path.join(cache_folder, body_name),
+            os.path.join(cache_folder, f"{content_hash}.{class_key}.subjects"))
+
+
+@contextmanager
+def atomic_write(file_path, compress=False):
+    # Write to a temporary file next to file_path and rename it into place
+    # once complete, so readers never see a half-written file
+    tmp_path = f"{file_path}.{secrets.token_hex(4)}.part"
+    try:
+        with open_output(tmp_path, compress) as f:
+            yield f
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def generated_file_path(file_path):
+    # The absolute path of file_path if it's a file under UPLOAD_FOLDER, else
+    # None. Paths come from the query string, so nothing outside the folder,
+    # nor its hidden blob and cache folders, is served or written next to.
+    upload_folder = os.path.realpath(app.config['UPLOAD_FOLDER'])
+    resolved = os.path.realpath(file_path)
+    if os.path.commonpath([upload_folder, resolved]) != upload_folder:
+        return None
+    relative = os.path.relpath(resolved, upload_folder)
+    if any(part.startswith('.') for part in relative.split(os.sep)) or not os.path.isfile(resolved):
+        return None
+    return resolved
+
+
 @app.route('/view_metadata')
 def view_metadata():
     rdf_data_path = request.args.get('rdf_data_path')
@@ -575,17 +2541,149 @@ def view_metadata():
 
     if rdf_data_path:
         logging.debug(f"Viewing RDF named graph data at: {rdf_data_path}")
-        with open(rdf_data_path, "r") as rdf_file:
-            rdf_content = rdf_file.read()
-        return Response(rdf_content, mimetype="text/turtle")
+        file_path = rdf_data_path
     elif rdf_star_data_path:
         logging.debug(f"Viewing RDF-star data at: {rdf_star_data_path}")
-        with open(rdf_star_data_path, "r") as rdf_star_file:
-            rdf_star_content = rdf_star_file.read()
-        return Response(rdf_star_content, mimetype="text/turtle")
+        file_path = rdf_star_data_path
     else:
         return "RDF data is not available for viewing."
 
+    file_path = generated_file_path(file_path)
+    if file_path is None:
+        return "No such metadata file.", 404
+    return metadata_file_response(file_path)
+
+
+def metadata_file_etag(file_path):
+    # Content hash of the file, recomputed only when its size or mtime changes
+    stat = os.stat(file_path)
+    with etag_lock:
+        cached = etag_cache.get(file_path)
+        if cached and cached[0] == (stat.st_size, stat.st_mtime):
+            etag_cache.move_to_end(file_path)
+            return cached[1]
+    etag = file_content_hash(file_path)
+    with etag_lock:
+        etag_cache[file_path] = ((stat.st_size, stat.st_mtime), etag)
+        while len(etag_cache) > ETAG_CACHE_SIZE:
+            etag_cache.popitem(last=False)
+    return etag
+
+
+class BrotliWriter:
+    # Writable file object brotli-compressing into f, like gzip.GzipFile
+    def __init__(self, f):
+        self.f = f
+        self.compressor = brotli.Compressor()
+
+    def write(self, data):
+        self.f.write(self.compressor.process(data))
+        return len(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.f.write(self.compressor.finish())
+
+
+def file_variant_path(file_path, name):
+    # Where the copy of the generated file_path called name is kept. Copies
+    # live in the cache folder rather than next to their source, so they are
+    # never mistaken for generated files themselves.
+    upload_folder = os.path.realpath(app.config['UPLOAD_FOLDER'])
+    variant_folder = os.path.join(upload_folder, SERIALIZATION_CACHE_FOLDER, VARIANT_FOLDER)
+    resolved = os.path.realpath(file_path)
+    if os.path.commonpath([variant_folder, resolved]) == variant_folder:
+        # A copy of a copy is kept with the rest of its source's copies
+        return os.path.join(os.path.dirname(resolved), name)
+    return os.path.join(variant_folder, os.path.relpath(resolved, upload_folder), name)
+
+
+def fresh_file_variant(variant_path, file_path):
+    # Whether the copy at variant_path is up to date with file_path, marking
+    # it as used so purge_file_variants keeps it
+    if os.path.exists(variant_path) and os.path.getmtime(variant_path) >= os.path.getmtime(file_path):
+        os.utime(variant_path)
+        return True
+    return False
+
+
+def precompressed_variant(file_path, encoding):
+    # Path of a compressed copy of file_path, written on first use and
+    # rewritten whenever the original changes. The original is streamed
+    # through the compressor rather than read into memory.
+    extension, open_compressor = PRECOMPRESSED_ENCODINGS[encoding]
+    variant_path = file_variant_path(file_path, os.path.basename(file_path) + extension)
+    if fresh_file_variant(variant_path, file_path):
+        return variant_path
+    os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+    with open(file_path, 'rb') as f, atomic_write(variant_path) as variant, open_compressor(variant) as out:
+        shutil.copyfileobj(f, out, UPLOAD_CHUNK_SIZE)
+    return variant_path
+
+
+def metadata_file_response(file_path, as_attachment=False, download_name=None, mimetype=None):
+    # Serve a generated file straight from disk. send_file takes care of Range
+    # and If-None-Match requests against the content hash ETag, and a gzip or
+    # brotli copy is sent instead when the client accepts it.
+    output_format, compressed = output_format_for_path(file_path)
+    mimetype = mimetype or OUTPUT_FORMATS[output_format or 'turtle'][1]
+    content_encoding = None
+
+    if compressed and not as_attachment:
+        # Compressed outputs are sent as they are and the browser decompresses them
+        content_encoding = 'gzip'
+    elif not compressed and os.path.getsize(file_path) >= PRECOMPRESS_MIN_SIZE:
+        for encoding in PRECOMPRESSED_ENCODINGS:
+            if encoding in request.accept_encodings:
+                file_path = precompressed_variant(file_path, encoding)
+                content_encoding = encoding
+                break
+
+    # send_file resolves relative paths against the app's directory, not the
+    # working directory UPLOAD_FOLDER is relative to
+    response = send_file(os.path.abspath(file_path),
+                         mimetype=mimetype,
+                         as_attachment=as_attachment,
+                         download_name=download_name,
+                         etag=metadata_file_etag(file_path),
+                         conditional=True)
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def convert_metadata_file(file_path, output_format, compress):
+    # Write a copy of a generated file in another format, reusing an earlier
+    # conversion if the source hasn't changed since
+    import pyoxigraph
+    source_format, source_compressed = output_format_for_path(file_path)
+    if source_format is None:
+        raise ValueError(f"{os.path.basename(file_path)} is not in a known output format")
+    if (output_format, compress) == (source_format, source_compressed):
+        return file_path
+    name = os.path.basename(file_path)
+    if name.endswith('.gz'):
+        name = name[:-len('.gz')]
+    converted_path = file_variant_path(file_path, os.path.splitext(name)[0] + output_extension(output_format, compress))
+    if fresh_file_variant(converted_path, file_path):
+        return converted_path
+    os.makedirs(os.path.dirname(converted_path), exist_ok=True)
+
+    graph = pyoxigraph.NamedNode(output_graph_name(file_path))
+    with open_metadata_file(file_path) as source:
+        statements = pyoxigraph.parse(source, OUTPUT_FORMATS[source_format][1], base_iri=graph.value)
+        if output_format in ('nq', 'trig') and source_format not in ('nq', 'trig'):
+            statements = (pyoxigraph.Quad(t.subject, t.predicate, t.object, graph) for t in statements)
+        elif output_format not in ('nq', 'trig') and source_format in ('nq', 'trig'):
+            statements = (q.triple for q in statements)
+        with (atomic_write(converted_path) as f,
+              gzip.GzipFile(fileobj=f, mode='wb') if compress else nullcontext(f) as out):
+            pyoxigraph.serialize(statements, out, OUTPUT_FORMATS[output_format][1])
+    return converted_path
+
 
 @app.route('/download_metadata')
 def download_metadata():
@@ -593,54 +2691,312 @@ def download_metadata():
     rdf_star_data_path = request.args.get('rdf_star_data_path')
 
     if rdf_data_path:
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        download_name = f"metadata_named_graph_{timestamp}.ttl"
-        return send_file(rdf_data_path,
-                         as_attachment=True,
-                         mimetype='text/turtle',
-                         download_name=download_name)
+        file_path = rdf_data_path
+        name_prefix = "metadata_named_graph"
     elif rdf_star_data_path:
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        download_name = f"metadata_rdf_star_{timestamp}.ttl"
-        return send_file(rdf_star_data_path,
-                         as_attachment=True,
-                         mimetype='text/turtle',
-                         download_name=download_name)
+        file_path = rdf_star_data_path
+        name_prefix = "metadata_rdf_star"
     else:
         return "RDF data is not available for download."
 
-
-# Function to save code, user ID, and timestamp to CSV
-def save_code_to_csv(code, user_id, filename='codes.csv'):
-    file_exists = os.path.isfile(filename)  # Check if the file already exists
-    with open(filename, 'a', newline='') as csvfile:
-        fieldnames = ['timestamp', 'user_id', 'code']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        # If file doesn't exist, write the header first
-        if not file_exists:
-            writer.writeheader()
-
-        # Write the data
-        writer.writerow({
-            'timestamp':
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'user_id':
-            user_id,
-            'code':
-            code
-        })
+    file_path = generated_file_path(file_path)
+    if file_path is None:
+        return "No such metadata file.", 404
+
+    # Optionally convert, e.g. ?format=nq&compress=gzip
+    output_format, compress = output_format_for_path(file_path)
+    requested_format = request.args.get('format', output_format)
+    requested_compress = request.args.get('compress', 'gzip' if compress else '') == 'gzip'
+    if requested_format not in OUTPUT_FORMATS:
+        return f"Unknown output format {requested_format}.", 400
+    if (requested_format, requested_compress) != (output_format, compress):
+        if output_format is None:
+            return "Only generated metadata files can be converted.", 400
+        try:
+            file_path = convert_metadata_file(file_path, requested_format, requested_compress)
+        except (SyntaxError, ValueError) as e:
+            return f"Could not convert the metadata to {requested_format}: {e}", 400
+
+    # Name the download after the file so repeated downloads get the same name
+    download_name = f"{name_prefix}_{os.path.basename(file_path)}"
+    return metadata_file_response(file_path, as_attachment=True, download_name=download_name,
+                                  mimetype='application/gzip' if requested_compress else None)
+
+
+def get_sparql_session():
+    # One keep-alive connection pool shared by all /sparql requests
+    global sparql_session
+    import requests
+    from requests.adapters import HTTPAdapter
+    with sparql_lock:
+        if sparql_session is None:
+            sparql_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=app.config['SPARQL_MAX_CONCURRENCY'])
+            sparql_session.mount('http://', adapter)
+            sparql_session.mount('https://', adapter)
+        return sparql_session
+
+
+def get_sparql_slots():
+    global sparql_slots
+    with sparql_lock:
+        if sparql_slots is None:
+            sparql_slots = threading.BoundedSemaphore(app.config['SPARQL_MAX_CONCURRENCY'])
+        return sparql_slots
+
+
+def is_generated_metadata_file(name):
+    return (output_format_for_path(name)[0] is not None
+            and (name.startswith('metadata_named_graph_') or '_rdf_star.' in name))
+
+
+def get_metadata_store():
+    # Each server process reads through its own secondary view of the on-disk
+    # store, which follows what refresh_metadata_store writes from any process
+    global metadata_store
+    import pyoxigraph
+    if metadata_store is None:
+        metadata_store = pyoxigraph.Store.secondary(app.config['METADATA_STORE'])
+    return metadata_store
+
+
+def open_metadata_store_for_writing():
+    # Only one process at a time can open the store read-write, so wait for
+    # whoever is indexing now to finish. Returns None if they don't in time.
+    import pyoxigraph
+    deadline = time.monotonic() + app.config['SPARQL_QUEUE_TIMEOUT']
+    while True:
+        try:
+            return pyoxigraph.Store(app.config['METADATA_STORE'])
+        except OSError as e:
+            if time.monotonic() > deadline:
+                logging.warning(f"Could not open the metadata store to index new files, "
+                                f"queries won't see them yet: {e}")
+                return None
+            time.sleep(0.05)
+
+
+def refresh_metadata_store():
+    # Load generated files that are new or changed since they were last indexed,
+    # each into its own named graph. Returns the store version, which changes
+    # whenever the store content does.
+    with metadata_store_lock:
+        conn = connect_db()
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        files = {}
+        with os.scandir(app.config['UPLOAD_FOLDER']) as entries:
+            for entry in entries:
+                if not entry.is_file() or not is_generated_metadata_file(entry.name):
+                    continue
+                if entry.name.endswith('.gz') and os.path.exists(entry.path[:-len('.gz')]):
+                    # Precompressed copy served by /view_metadata, not an output of its own
+                    continue
+                files[os.path.abspath(entry.path)] = entry.stat().st_mtime
+        indexed = dict(conn.execute("SELECT file_path, mtime FROM indexed_metadata_files").fetchall())
+
+        if any(indexed.get(file_path) != mtime for file_path, mtime in files.items()) \
+                or not os.path.isdir(app.config['METADATA_STORE']):
+            store = open_metadata_store_for_writing()
+            if store is not None:
+                # Another process may have indexed some of them while we waited
+                indexed = dict(conn.execute("SELECT file_path, mtime FROM indexed_metadata_files").fetchall())
+                for file_path, mtime in files.items():
+                    if indexed.get(file_path) != mtime:
+                        index_metadata_file(store, file_path)
+                        with conn:
+                            conn.execute("INSERT OR REPLACE INTO indexed_metadata_files (file_path, mtime) "
+                                         "VALUES (?, ?)", (file_path, mtime))
+                store.flush()
+                # Dropping the last reference closes it for the next writer
+                del store
+
+        # Every write to indexed_metadata_files gets a higher rowid
+        version = conn.execute("SELECT MAX(rowid) FROM indexed_metadata_files").fetchone()[0] or 0
+        conn.close()
+        return version
+
+
+def index_metadata_file(store, file_path):
+    import pyoxigraph
+    graph = pyoxigraph.NamedNode(output_graph_name(file_path))
+    if store.contains_named_graph(graph):
+        store.remove_graph(graph)
+    output_format = output_format_for_path(file_path)[0]
+    try:
+        # The quad formats already put everything in the file's graph
+        to_graph = None if output_format in ('nq', 'trig') else graph
+        with open_metadata_file(file_path) as f:
+            store.load(f, OUTPUT_FORMATS[output_format][1], base_iri=graph.value, to_graph=to_graph)
+    except SyntaxError as e:
+        logging.error(f"Could not index {file_path}: {e}")
+
+
+def normalize_sparql_query(query):
+    # Drop comments and collapse whitespace outside of string literals and
+    # IRIs so trivially different spellings of the same query share a cache
+    # entry. A comment runs to the end of its line, so it has to go before the
+    # newline that ends it does.
+    return SPARQL_TOKEN.sub(lambda match: match.group(1) or ' ', query).strip()
+
+
+def sparql_json_term(term):
+    import pyoxigraph
+    if isinstance(term, pyoxigraph.NamedNode):
+        return {'type': 'uri', 'value': term.value}
+    if isinstance(term, pyoxigraph.BlankNode):
+        return {'type': 'bnode', 'value': term.value}
+    if isinstance(term, pyoxigraph.Triple):
+        return {'type': 'triple', 'value': {
+            'subject': sparql_json_term(term.subject),
+            'predicate': sparql_json_term(term.predicate),
+            'object': sparql_json_term(term.object),
+        }}
+    literal = {'type': 'literal', 'value': term.value}
+    if term.language:
+        literal['xml:lang'] = term.language
+    elif term.datatype.value != XSD.string:
+        literal['datatype'] = term.datatype.value
+    return literal
+
+
+def run_local_sparql(query):
+    # Evaluate the query over the union of all generated graphs and return
+    # (content type, serialized results)
+    import pyoxigraph
+    results = get_metadata_store().query(query, use_default_graph_as_union=True)
+    if isinstance(results, bool):
+        return 'application/sparql-results+json', json.dumps({'head': {}, 'boolean': results}).encode('utf-8')
+    if isinstance(results, pyoxigraph.QuerySolutions):
+        variables = [variable.value for variable in results.variables]
+        bindings = []
+        for solution in results:
+            binding = {}
+            for variable in variables:
+                term = solution[variable]
+                if term is not None:
+                    binding[variable] = sparql_json_term(term)
+            bindings.append(binding)
+        body = {'head': {'vars': variables}, 'results': {'bindings': bindings}}
+        return 'application/sparql-results+json', json.dumps(body).encode('utf-8')
+    return 'application/n-triples', ''.join(f"{triple} .\n" for triple in results).encode('utf-8')
+
+
+def local_sparql(query):
+    global sparql_query_executor
+    store_version = refresh_metadata_store()
+    cache_key = (normalize_sparql_query(query), store_version)
+    with metadata_store_lock:
+        cached = sparql_result_cache.get(cache_key)
+        if cached is not None:
+            sparql_result_cache.move_to_end(cache_key)
+            return Response(cached[1], content_type=cached[0])
+        if sparql_query_executor is None:
+            sparql_query_executor = ThreadPoolExecutor(max_workers=app.config['SPARQL_MAX_CONCURRENCY'])
+
+    slots = get_sparql_slots()
+    if not slots.acquire(timeout=app.config['SPARQL_QUEUE_TIMEOUT']):
+        return "Too many SPARQL queries are running, please try again in a moment.", 503, {'Retry-After': '5'}
+
+    # A query that runs past the timeout can't be interrupted, so it keeps its
+    # slot until it actually finishes
+    future = sparql_query_executor.submit(run_local_sparql, query)
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        content_type, body = future.result(timeout=app.config['SPARQL_TIMEOUT'])
+    except TimeoutError:
+        return "The SPARQL query took too long.", 504
+    except (SyntaxError, ValueError, OSError) as e:
+        return f"SPARQL query failed: {e}", 400
+
+    with metadata_store_lock:
+        sparql_result_cache[cache_key] = (content_type, body)
+        while len(sparql_result_cache) > app.config['SPARQL_CACHE_SIZE']:
+            sparql_result_cache.popitem(last=False)
+    return Response(body, content_type=content_type)
 
 
 @app.route('/sparql', methods=['GET', 'POST'])
 def sparql():
     if request.method == 'POST':
         query = request.form['query']
-        headers = {"Content-Type": "application/sparql-query"}
-        response = requests.post(GRAPHDB_URL, data=query, headers=headers)
-        return response.text
+        if app.config['SPARQL_BACKEND'] == 'local':
+            return local_sparql(query)
+
+        endpoint = app.config['GRAPHDB_URL']
+        if not endpoint:
+            return "No SPARQL endpoint is configured, set GRAPHDB_URL.", 503
+        import requests
+
+        # Limit how many queries we proxy at once, each one holds a worker thread
+        slots = get_sparql_slots()
+        if not slots.acquire(timeout=app.config['SPARQL_QUEUE_TIMEOUT']):
+            return "Too many SPARQL queries are running, please try again in a moment.", 503, {'Retry-After': '5'}
+
+        headers = {
+            "Content-Type": "application/sparql-query",
+            "Accept": request.headers.get('Accept', 'application/sparql-results+json'),
+        }
+        try:
+            response = get_sparql_session().post(
+                endpoint, data=query.encode('utf-8'), headers=headers, stream=True,
+                timeout=(app.config['SPARQL_CONNECT_TIMEOUT'], app.config['SPARQL_TIMEOUT']))
+        except requests.RequestException as e:
+            slots.release()
+            logging.error(f"SPARQL request to {endpoint} failed: {e}")
+            return f"SPARQL endpoint request failed: {e}", 502
+
+        # Pass the results through as they arrive instead of buffering them
+        def stream_results():
+            try:
+                yield from response.iter_content(chunk_size=SPARQL_CHUNK_SIZE)
+            finally:
+                response.close()
+                slots.release()
+
+        return Response(stream_results(), status=response.status_code,
+                        content_type=response.headers.get('Content-Type', 'text/plain'))
     return render_template('sparql.html')
 
 
+# A tiny mapping that goes through every parser and serializer the pipeline uses
+WARM_UP_MAPPING = b"""@prefix rr: <http://www.w3.org/ns/r2rml#> .
+<http://example.com/warm-up> a rr:TriplesMap .
+"""
+WARM_UP_QUERY = "INSERT { ?a <http://www.w3.org/2002/07/owl#sameAs> ?b } WHERE { ?a <http://example.com/p> ?b }"
+
+
+def warm_up():
+    # Do the one-off work of a worker's first requests up front: create the
+    # upload folder, database schema and participant code pool, load the rdflib
+    # and pyoxigraph parsers/serializers, build rdflib's SPARQL grammar and
+    # compile the templates
+    import pyoxigraph
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    create_code_pool()
+    for name in ('turtle', 'xml', 'nt', 'nquads'):
+        plugin.get(name, Parser)
+    for name in ('turtle', 'nt'):
+        plugin.get(name, Serializer)
+    g = Graph()
+    g.parse(data=WARM_UP_MAPPING, format='turtle')
+    g.serialize(format='turtle')
+    g.serialize(format='nt')
+    list(pyoxigraph.parse(io.BytesIO(WARM_UP_MAPPING), SCANNABLE_FORMATS['turtle']))
+    # Not analyze_interlink_query, which would cache the result on disk
+    parse_interlink_query(WARM_UP_QUERY)
+    for template in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template)
+
+
+@app.cli.command('warm-up')
+def warm_up_command():
+    """Precompile the app's bytecode and run warm_up(), e.g. while building a container image."""
+    import compileall
+    compileall.compile_dir(os.path.dirname(os.path.abspath(__file__)), maxlevels=0, quiet=1)
+    warm_up()
+    print("Warmed up")
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=int(os.getenv('PORT', 8080)), debug=True)
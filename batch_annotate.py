@@ -0,0 +1,62 @@
+"""Annotate every mapping file in a directory or archive with the same metadata.
+
+Usage:
+    python batch_annotate.py metadata.json upload/ --workers 4
+    python batch_annotate.py metadata.json mappings.zip
+
+metadata.json holds the add_metadata.html form fields, e.g.
+{"fname": "...", "mappingType": "Uplift Mapping", ...}. Each mapping gets a
+<file>_<key>_rdf_star.ttl next to it, <key> identifying the content and metadata.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from app import annotate_mapping_directory, extract_mapping_archive
+
+
+def print_result(result):
+    if 'error' in result:
+        print(f"FAILED  {result['file']}: {result['error']}")
+    else:
+        print(f"ok      {result['file']}  {result['bytes']} bytes  {result['seconds']:.3f}s  "
+              f"{result['bytes_per_second'] / 1024:.0f} KiB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate many mapping files with the same metadata.")
+    parser.add_argument('metadata', help="JSON file with the metadata form fields")
+    parser.add_argument('mappings', help="Directory or .zip/.tar archive of mapping files")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes")
+    parser.add_argument('--output', help="Directory to extract archives into (default: a temporary directory)")
+    parser.add_argument('--json', action='store_true', help="Print the full report as JSON")
+    args = parser.parse_args()
+
+    with open(args.metadata, encoding='utf-8') as f:
+        form_data = json.load(f)
+
+    directory = args.mappings
+    if not os.path.isdir(directory):
+        directory = args.output or tempfile.mkdtemp(prefix='metamap_batch_')
+        os.makedirs(directory, exist_ok=True)
+        with open(args.mappings, 'rb') as archive:
+            extract_mapping_archive(archive, directory)
+
+    report = annotate_mapping_directory(directory, form_data, workers=args.workers,
+                                        on_result=None if args.json else print_result)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"\n{report['files']} files, {report['failed']} failed, {report['bytes']} bytes in "
+              f"{report['seconds']:.2f}s ({(report['bytes_per_second'] or 0) / 1024:.0f} KiB/s)")
+        if directory != args.mappings:
+            print(f"Output written to {directory}")
+
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
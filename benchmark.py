@@ -0,0 +1,358 @@
+"""Benchmark the upload -> submit_metadata pipeline on synthetic mappings.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --sizes 10 1000 100000 --kinds uplift alignment
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --compare benchmark_baseline.json --tolerance 0.25
+
+Synthetic RML mappings (uplift), EDOAL alignments (alignment) and SPARQL
+interlinking queries (interlink) are generated deterministically with the
+requested number of triples (triple patterns for queries), uploaded through
+the Flask test client and annotated with the same metadata form. Every case
+runs in a fresh process so peak RSS belongs to that case alone. Latencies are
+the median over --repeat runs.
+
+Cold start is measured first: a fresh interpreter importing app and serving
+its first request, without and with warm_up().
+
+--compare exits with status 1 when a case is slower, or uses more memory, than
+the baseline by more than --tolerance, or when the cold start takes longer than
+--startup-budget.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000, 1000000]
+QUICK_SIZES = [10, 100, 1000, 10000]
+KINDS = {
+    'uplift': ('Uplift Mapping', 'ttl'),
+    'alignment': ('Ontologies Alignment', 'ttl'),
+    'interlink': ('Interlinking', 'rq'),
+}
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+
+# Differences below these are noise on small cases, whatever the tolerance
+COMPARED_METRICS = {'total_seconds': 0.05, 'peak_rss_mb': 5}
+STARTUP_METRICS = {'import_seconds': 0.05, 'ready_seconds': 0.05}
+DEFAULT_STARTUP_BUDGET = 1.0
+
+# Run by measure_startup() in a fresh interpreter
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+if sys.argv[1] == 'warm':
+    app.warm_up()
+warmed = time.perf_counter()
+app.app.test_client().get('/')
+done = time.perf_counter()
+print(json.dumps({'import_seconds': imported - start, 'warm_up_seconds': warmed - imported,
+                  'first_request_seconds': done - warmed, 'ready_seconds': done - start}))
+"""
+
+# Values for every field of static/add_metadata.html
+FORM_DATA = {
+    'fname': 'Bench', 'lname': 'Mark', 'background': 'Computer Science', 'role': 'Researcher',
+    'organization': 'Benchmark', 'requirement': 'Benchmark the annotation pipeline',
+    'mappingDomain': 'Synthetic', 'mappingAssumptions': 'None', 'technicalRequirement': 'None',
+    'risksIssues': 'None', 'InputURI': 'http://example.com/input', 'InputSource': 'Synthetic CSV',
+    'StartDate': '2024-01-01', 'EndDate': '2024-01-02', 'Tool': 'benchmark.py', 'MappingMethod': 'Generated',
+    'mappingURI': 'http://example.com/mapping', 'mappingName': 'Synthetic mapping',
+    'mappingAlgorithm': 'None', 'mappingFormat': 'RML', 'testingURI': 'http://example.com/test',
+    'testingName': 'Benchmark', 'testingType': 'Performance', 'testingDate': '2024-01-03',
+    'testingResult': 'Pass', 'publisherName': 'Benchmark', 'publisherSource': 'http://example.com/',
+    'versionNumber': '1.0', 'versionDateTime': '2024-01-04T00:00:00',
+}
+
+# Triples written per TriplesMap / Cell by the generators below
+TRIPLES_PER_MAP = 12
+TRIPLES_PER_CELL = 6
+CELLS_PER_ALIGNMENT = 100
+
+
+def generate_uplift(size, f):
+    f.write(b"@prefix rr: <http://www.w3.org/ns/r2rml#> .\n"
+            b"@prefix rml: <http://semweb.mmlab.be/ns/rml#> .\n"
+            b"@prefix ql: <http://semweb.mmlab.be/ns/ql#> .\n"
+            b"@prefix ex: <http://example.com/> .\n\n")
+    maps = max(1, -(-size // TRIPLES_PER_MAP))
+    for i in range(maps):
+        f.write(f"""ex:TriplesMap{i} a rr:TriplesMap ;
+    rml:logicalSource [ rml:source "table{i}.csv" ; rml:referenceFormulation ql:CSV ] ;
+    rr:subjectMap [ rr:template "http://example.com/entity{i}/{{id}}" ; rr:class ex:Class{i} ] ;
+    rr:predicateObjectMap [ rr:predicate ex:property{i} ; rr:objectMap [ rml:reference "column{i}" ] ] .
+
+""".encode('utf-8'))
+    return maps * TRIPLES_PER_MAP
+
+
+def generate_alignment(size, f):
+    f.write(b"@prefix align: <http://knowledgeweb.semanticweb.org/heterogeneity/alignment#> .\n"
+            b"@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .\n\n")
+    cells = max(1, -(-size // TRIPLES_PER_CELL))
+    alignments = -(-cells // CELLS_PER_ALIGNMENT)
+    for a in range(alignments):
+        f.write(f"<http://example.com/alignment{a}> a align:Alignment ;\n"
+                f"    align:onto1 <http://example.com/source{a}> ;\n"
+                f"    align:onto2 <http://example.com/target{a}>".encode('utf-8'))
+        for c in range(a * CELLS_PER_ALIGNMENT, min(cells, (a + 1) * CELLS_PER_ALIGNMENT)):
+            f.write(f""" ;
+    align:map [ a align:Cell ;
+        align:entity1 <http://example.com/source{a}#Entity{c}> ;
+        align:entity2 <http://example.com/target{a}#Entity{c}> ;
+        align:relation "=" ;
+        align:measure "1.0"^^xsd:float ]""".encode('utf-8'))
+        f.write(b" .\n\n")
+    return alignments * 3 + cells * TRIPLES_PER_CELL
+
+
+def generate_interlink(size, f):
+    f.write(b"PREFIX owl: <http://www.w3.org/2002/07/owl#>\n"
+            b"PREFIX ex: <http://example.com/>\n\n"
+            b"INSERT {\n  ?entity0 owl:sameAs ?other0 .\n}\nWHERE {\n")
+    for i in range(size):
+        f.write(f"  ?entity{i} ex:property{i} ?other{i} .\n".encode('utf-8'))
+    f.write(b"}\n")
+    return size
+
+
+GENERATORS = {
+    'uplift': generate_uplift,
+    'alignment': generate_alignment,
+    'interlink': generate_interlink,
+}
+
+
+def run_case(kind, size, queue):
+    # Runs in a fresh process: generate the mapping, then upload and annotate it
+    work_dir = tempfile.mkdtemp(prefix='metamap_bench_')
+    os.chdir(work_dir)
+    from app import app, metric_values, warm_up
+
+    app.config['UPLOAD_FOLDER'] = work_dir
+    app.config['DATABASE'] = os.path.join(work_dir, 'metamap.db')
+    app.config['ASYNC_METADATA_JOBS'] = False
+    app.config['TESTING'] = True
+    # Like a gunicorn worker, which warms up before taking requests
+    warm_up()
+
+    mapping_type, extension = KINDS[kind]
+    file_name = f"synthetic_{kind}_{size}.{extension}"
+    data = io.BytesIO()
+    triples = GENERATORS[kind](size, data)
+    data = data.getvalue()
+
+    client = app.test_client()
+    start = time.perf_counter()
+    response = client.post('/upload', data={'file': (io.BytesIO(data), file_name), 'participant_id': 'benchmark'},
+                           content_type='multipart/form-data')
+    upload_seconds = time.perf_counter() - start
+    if response.status_code != 200:
+        queue.put({'error': f"upload failed with status {response.status_code}: {response.get_data(as_text=True)[:200]}"})
+        return
+
+    start = time.perf_counter()
+    response = client.post('/submit_metadata', data=dict(FORM_DATA, mappingType=mapping_type))
+    submit_seconds = time.perf_counter() - start
+    if response.status_code != 200:
+        queue.put({'error': f"submit_metadata failed with status {response.status_code}"})
+        return
+
+    stages = {}
+    for labels, (_, total, _) in metric_values['metamap_stage_seconds'].items():
+        stage = dict(labels)['stage']
+        stages[stage] = stages.get(stage, 0) + total
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+    queue.put({
+        'triples': triples,
+        'bytes': len(data),
+        'upload_seconds': upload_seconds,
+        'submit_seconds': submit_seconds,
+        'stages': stages,
+        'peak_rss_mb': peak_rss_mb,
+    })
+
+
+def measure(kind, size, repeat):
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for _ in range(repeat):
+        queue = context.Queue()
+        process = context.Process(target=run_case, args=(kind, size, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        if 'error' in result:
+            return {'kind': kind, 'size': size, 'error': result['error']}
+        runs.append(result)
+
+    upload_seconds = statistics.median(run['upload_seconds'] for run in runs)
+    submit_seconds = statistics.median(run['submit_seconds'] for run in runs)
+    total_seconds = upload_seconds + submit_seconds
+    return {
+        'kind': kind,
+        'size': size,
+        'triples': runs[0]['triples'],
+        'bytes': runs[0]['bytes'],
+        'upload_seconds': upload_seconds,
+        'submit_seconds': submit_seconds,
+        'total_seconds': total_seconds,
+        'triples_per_second': runs[0]['triples'] / total_seconds if total_seconds else None,
+        'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+        'stages': {stage: statistics.median(run['stages'].get(stage, 0) for run in runs)
+                   for stage in runs[0]['stages']},
+    }
+
+
+def measure_startup(repeat):
+    # Median import, warm-up and first request times of a cold interpreter, in a
+    # scratch directory so nothing is created next to the app
+    repo = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [repo, os.getenv('PYTHONPATH')])))
+    startup = {}
+    for mode in ('cold', 'warm'):
+        runs = []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory(prefix='metamap_bench_') as work_dir:
+                start = time.perf_counter()
+                output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, mode], cwd=work_dir, env=env,
+                                        capture_output=True, text=True, check=True).stdout
+                run = json.loads(output.splitlines()[-1])
+                run['process_seconds'] = time.perf_counter() - start
+                runs.append(run)
+        startup[mode] = {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+    return startup
+
+
+def print_startup(startup):
+    for mode, result in startup.items():
+        print(f"startup {mode:<4}  import {result['import_seconds']:.3f}s  warm-up {result['warm_up_seconds']:.3f}s  "
+              f"first request {result['first_request_seconds']:.3f}s  ready {result['ready_seconds']:.3f}s  "
+              f"process {result['process_seconds']:.3f}s")
+
+
+def compare_startup(startup, baseline, tolerance, budget):
+    regressions = []
+    if startup['cold']['ready_seconds'] > budget:
+        regressions.append(f"startup: ready in {startup['cold']['ready_seconds']:.3f}s, over the {budget:.3f}s budget")
+    for mode, before in (baseline or {}).items():
+        for metric, min_delta in STARTUP_METRICS.items():
+            now = startup[mode][metric]
+            if now > before[metric] * (1 + tolerance) and now - before[metric] > min_delta:
+                regressions.append(f"startup {mode}: {metric} {before[metric]:.3f} -> {now:.3f} "
+                                   f"(+{now / before[metric] - 1:.0%})")
+    return regressions
+
+
+def print_result(result):
+    if 'error' in result:
+        print(f"{result['kind']:<10} {result['size']:>8}  FAILED: {result['error']}")
+        return
+    print(f"{result['kind']:<10} {result['size']:>8}  upload {result['upload_seconds']:8.3f}s  "
+          f"submit {result['submit_seconds']:8.3f}s  {result['triples_per_second']:10.0f} triples/s  "
+          f"peak RSS {result['peak_rss_mb']:7.1f} MiB")
+
+
+def compare(results, baseline, tolerance):
+    # Return a line per case that regressed against the baseline
+    previous = {(result['kind'], result['size']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['kind'], result['size']))
+        if before is None or 'error' in before:
+            continue
+        if 'error' in result:
+            regressions.append(f"{result['kind']} {result['size']}: {result['error']}")
+            continue
+        for metric, min_delta in COMPARED_METRICS.items():
+            if result[metric] > before[metric] * (1 + tolerance) and result[metric] - before[metric] > min_delta:
+                regressions.append(f"{result['kind']} {result['size']}: {metric} {before[metric]:.3f} -> "
+                                   f"{result[metric]:.3f} (+{result[metric] / before[metric] - 1:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MetaMap on synthetic mappings of growing size.")
+    parser.add_argument('--sizes', type=int, nargs='+', help="Mapping sizes in triples (default: 10 to 1M)")
+    parser.add_argument('--quick', action='store_true', help="Only run sizes up to 10,000 triples")
+    parser.add_argument('--kinds', nargs='+', choices=sorted(KINDS), default=list(KINDS))
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case, latencies are the median")
+    parser.add_argument('--json', action='store_true', help="Print the full report as JSON")
+    parser.add_argument('--save-baseline', metavar='PATH', nargs='?', const=DEFAULT_BASELINE,
+                        help=f"Store the results as a baseline (default: {DEFAULT_BASELINE})")
+    parser.add_argument('--compare', metavar='PATH', nargs='?', const=DEFAULT_BASELINE,
+                        help=f"Compare against a stored baseline (default: {DEFAULT_BASELINE})")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Allowed slowdown/memory growth before --compare fails (default: 0.25)")
+    parser.add_argument('--startup-budget', type=float, default=DEFAULT_STARTUP_BUDGET,
+                        help=f"Seconds a cold worker may take to serve its first request (default: {DEFAULT_STARTUP_BUDGET})")
+    parser.add_argument('--startup-only', action='store_true', help="Only measure the cold start")
+    args = parser.parse_args()
+
+    startup = measure_startup(args.repeat)
+    if not args.json:
+        print_startup(startup)
+
+    sizes = [] if args.startup_only else args.sizes or (QUICK_SIZES if args.quick else DEFAULT_SIZES)
+    results = []
+    for kind in args.kinds:
+        for size in sizes:
+            result = measure(kind, size, args.repeat)
+            results.append(result)
+            if not args.json:
+                print_result(result)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'startup': startup,
+        'results': results,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f"Baseline written to {args.save_baseline}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_startup(startup, baseline.get('startup'), args.tolerance, args.startup_budget)
+        regressions += compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION  {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare}", file=sys.stderr)
+
+    if startup['cold']['ready_seconds'] > args.startup_budget:
+        print(f"Cold start took {startup['cold']['ready_seconds']:.3f}s, over the "
+              f"{args.startup_budget:.3f}s budget", file=sys.stderr)
+        return 1
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,34 @@
+# Production server settings:
+#     gunicorn -c gunicorn.conf.py app:app
+#
+# Each worker is a separate process. Uploads, participant codes, jobs, the
+# catalog and metrics live in DATABASE and UPLOAD_FOLDER, so every worker (and
+# every node, when both are on shared storage) sees the same state, and all of
+# them need the same SECRET_KEY. Send SIGHUP to the master process to reload the
+# code and replace the workers gracefully.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# The app shares JOB_WORKERS job processes out between the workers
+os.environ['WEB_CONCURRENCY'] = str(workers)
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+
+# Annotating a large mapping in the request can take minutes
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 300))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 60))
+keepalive = 5
+
+# Recycle workers now and then so the per-process caches can't grow forever
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+reload = os.getenv('GUNICORN_RELOAD', '0') == '1'
+
+
+def post_worker_init(_worker):
+    # Load parsers, templates and the database schema before taking requests
+    from app import warm_up
+    warm_up()
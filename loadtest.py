@@ -0,0 +1,291 @@
+"""Replay concurrent study sessions against MetaMap and report latency per route.
+
+Usage:
+    python loadtest.py
+    python loadtest.py --participants 200 --concurrency 50 --ramp 30
+    python loadtest.py --url http://localhost:8080 --think-time 2
+
+Every simulated participant goes through the study workflow: open the home
+page, upload one of the sample mappings (static/uplift_mapping.ttl,
+static/ontology_alignment.ttl or upload/interlinking.rq, in turn), submit the
+add_metadata.html form for it, wait for the job when the server runs them
+asynchronously, and view both generated files.
+
+--concurrency participants are active at once, and they start evenly spread
+over the first --ramp seconds. Without --url a server is started with
+gunicorn.conf.py in a temporary directory, so the study's uploads and database
+aren't touched, and stopped at the end.
+
+Reports the number of requests, error rate, p50/p95/p99 latency and throughput
+per route, and exits with status 1 when the error rate is above
+--max-error-rate.
+"""
+import argparse
+import json
+import os
+import re
+import secrets
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from html import unescape
+from urllib.parse import urljoin
+
+import requests
+
+from benchmark import FORM_DATA
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+SAMPLES = [
+    ('static/uplift_mapping.ttl', 'Uplift Mapping'),
+    ('static/ontology_alignment.ttl', 'Ontologies Alignment'),
+    ('upload/interlinking.rq', 'Interlinking'),
+]
+VIEW_LINK = re.compile(r'href="(/view_metadata\?[^"]+)"')
+JOB_POLL_INTERVAL = 0.5
+PERCENTILES = (50, 95, 99)
+
+
+class Recorder:
+    # Collects (seconds, ok) per route from every participant thread
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, route, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(route, []).append((seconds, ok))
+
+
+class SessionFailed(Exception):
+    pass
+
+
+def timed_request(recorder, route, session, method, url, **kwargs):
+    # Make one request and record it under route. Connection errors and 4xx/5xx
+    # responses count as errors and end the participant's session.
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException as e:
+        recorder.add(route, time.perf_counter() - start, False)
+        raise SessionFailed(f"{route}: {e}") from e
+    ok = response.status_code < 400
+    recorder.add(route, time.perf_counter() - start, ok)
+    if not ok:
+        raise SessionFailed(f"{route}: status {response.status_code} {response.text[:200]}")
+    return response
+
+
+def run_session(base_url, participant, samples, recorder, think_time, timeout):
+    sample_path, mapping_type, data = samples[participant % len(samples)]
+    participant_id = f"load-{participant}"
+    form_data = dict(FORM_DATA, mappingType=mapping_type, fname=f"Participant {participant}",
+                     mappingName=f"{os.path.basename(sample_path)} for {participant_id}")
+
+    with requests.Session() as session:
+        timed_request(recorder, '/', session, 'GET', urljoin(base_url, '/'), timeout=timeout)
+        time.sleep(think_time)
+        # A rejected mapping is answered with a 400 and ends the session
+        timed_request(recorder, '/upload', session, 'POST', urljoin(base_url, '/upload'),
+                      files={'file': (os.path.basename(sample_path), data)},
+                      data={'participant_id': participant_id}, timeout=timeout)
+        time.sleep(think_time)
+
+        response = timed_request(recorder, '/submit_metadata', session, 'POST', urljoin(base_url, '/submit_metadata'),
+                                 data=form_data, allow_redirects=False, timeout=timeout)
+        if response.is_redirect:
+            # ASYNC_METADATA_JOBS: poll the job until its files are written
+            job_url = urljoin(base_url, response.headers['Location'])
+            while True:
+                job = timed_request(recorder, '/jobs/<job_id>', session, 'GET', job_url,
+                                    headers={'Accept': 'application/json'}, timeout=timeout).json()
+                if job['status'] == 'failed':
+                    raise SessionFailed(f"job failed: {job['error']}")
+                if job['status'] == 'done':
+                    break
+                time.sleep(JOB_POLL_INTERVAL)
+            views = [('/view_metadata', {'rdf_data_path': job['named_graph_path']}),
+                     ('/view_metadata', {'rdf_star_data_path': job['rdf_star_path']})]
+        else:
+            views = [(unescape(link), None) for link in VIEW_LINK.findall(response.text)]
+            if not views:
+                recorder.add('/submit_metadata', 0, False)
+                raise SessionFailed("/submit_metadata: no links to the generated files")
+        time.sleep(think_time)
+
+        for path, params in views:
+            timed_request(recorder, '/view_metadata', session, 'GET', urljoin(base_url, path), params=params,
+                          timeout=timeout)
+
+
+def run_load(base_url, participants, concurrency, ramp, think_time, timeout):
+    # Start concurrency threads, spread over ramp seconds, that each run
+    # sessions until participants sessions have been started
+    samples = []
+    for sample_path, mapping_type in SAMPLES:
+        with open(os.path.join(REPO, sample_path), 'rb') as f:
+            samples.append((sample_path, mapping_type, f.read()))
+
+    recorder = Recorder()
+    failures = []
+    next_participant = iter(range(participants))
+    participant_lock = threading.Lock()
+
+    def worker(delay):
+        time.sleep(delay)
+        while True:
+            with participant_lock:
+                participant = next(next_participant, None)
+            if participant is None:
+                return
+            try:
+                run_session(base_url, participant, samples, recorder, think_time, timeout)
+            except SessionFailed as e:
+                with participant_lock:
+                    failures.append(f"participant {participant}: {e}")
+
+    concurrency = min(concurrency, participants)
+    threads = [threading.Thread(target=worker, args=(ramp * index / concurrency,), daemon=True)
+               for index in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    return summarize(recorder.samples, seconds, participants, failures)
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile
+    index = max(0, -(-len(sorted_values) * p // 100) - 1)
+    return sorted_values[index]
+
+
+def route_summary(samples, seconds):
+    latencies = sorted(latency for latency, _ in samples)
+    errors = sum(1 for _, ok in samples if not ok)
+    summary = {
+        'requests': len(samples),
+        'errors': errors,
+        'error_rate': errors / len(samples),
+        'requests_per_second': len(samples) / seconds if seconds else None,
+        'mean_seconds': sum(latencies) / len(latencies),
+        'max_seconds': latencies[-1],
+    }
+    for p in PERCENTILES:
+        summary[f"p{p}_seconds"] = percentile(latencies, p)
+    return summary
+
+
+def summarize(samples, seconds, participants, failures):
+    routes = {route: route_summary(route_samples, seconds) for route, route_samples in sorted(samples.items())}
+    all_samples = [sample for route_samples in samples.values() for sample in route_samples]
+    return {
+        'participants': participants,
+        'failed_sessions': len(failures),
+        'seconds': seconds,
+        'sessions_per_second': (participants - len(failures)) / seconds if seconds else None,
+        'total': route_summary(all_samples, seconds) if all_samples else None,
+        'routes': routes,
+        'failures': failures,
+    }
+
+
+def print_report(report):
+    print(f"{'route':<18} {'requests':>8} {'errors':>7} {'req/s':>7}  "
+          + '  '.join(f"{f'p{p}':>7}" for p in PERCENTILES) + f"  {'max':>7}")
+    rows = list(report['routes'].items())
+    if report['total']:
+        rows.append(('total', report['total']))
+    for route, summary in rows:
+        print(f"{route:<18} {summary['requests']:>8} {summary['error_rate']:>7.1%} "
+              f"{summary['requests_per_second']:>7.1f}  "
+              + '  '.join(f"{summary[f'p{p}_seconds']:>6.3f}s" for p in PERCENTILES)
+              + f"  {summary['max_seconds']:>6.3f}s")
+    print(f"\n{report['participants']} sessions, {report['failed_sessions']} failed, in {report['seconds']:.1f}s "
+          f"({report['sessions_per_second']:.2f} sessions/s)")
+    for failure in report['failures'][:10]:
+        print(f"  {failure}")
+
+
+def start_server(port, workers, log_path):
+    # gunicorn with the production settings, working in a scratch directory
+    work_dir = tempfile.mkdtemp(prefix='metamap_load_')
+    env = dict(os.environ, PORT=str(port), SECRET_KEY=secrets.token_hex(16),
+               METAMAP_DATABASE=os.path.join(work_dir, 'metamap.db'),
+               METADATA_STORE=os.path.join(work_dir, 'metadata_store'))
+    if workers:
+        env['WEB_CONCURRENCY'] = str(workers)
+    with open(log_path, 'wb') as log:
+        server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO, 'gunicorn.conf.py'),
+                                   '--chdir', work_dir, '--pythonpath', REPO, 'app:app'],
+                                  env=env, stdout=subprocess.DEVNULL, stderr=log)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server exited with status {server.returncode}, see {log_path}")
+        try:
+            requests.get(base_url, timeout=1)
+            return server, base_url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    stop_server(server)
+    raise RuntimeError(f"The server didn't start within 60s, see {log_path}")
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test MetaMap with concurrent study participants.")
+    parser.add_argument('--url', help="Server to test (default: start one locally with gunicorn)")
+    parser.add_argument('--participants', type=int, default=50, help="Sessions to run in total")
+    parser.add_argument('--concurrency', type=int, default=10, help="Sessions running at the same time")
+    parser.add_argument('--ramp', type=float, default=5, help="Seconds over which the concurrent sessions start")
+    parser.add_argument('--think-time', type=float, default=0, help="Seconds a participant waits between steps")
+    parser.add_argument('--timeout', type=float, default=300, help="Seconds to wait for a response")
+    parser.add_argument('--port', type=int, default=8090, help="Port of the local server")
+    parser.add_argument('--workers', type=int, help="gunicorn workers of the local server (default: WEB_CONCURRENCY)")
+    parser.add_argument('--server-log', default=os.path.join(tempfile.gettempdir(), 'metamap_loadtest.log'),
+                        help="Where the local server's log goes")
+    parser.add_argument('--max-error-rate', type=float, default=0.0,
+                        help="Exit with status 1 above this fraction of failed requests")
+    parser.add_argument('--json', action='store_true', help="Print the full report as JSON")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        server, base_url = start_server(args.port, args.workers, args.server_log)
+    try:
+        report = run_load(base_url, args.participants, args.concurrency, args.ramp, args.think_time, args.timeout)
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    report['url'] = base_url
+    report['concurrency'] = args.concurrency
+    report['ramp_seconds'] = args.ramp
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    total = report['total']
+    return 1 if total is None or total['error_rate'] > args.max_error_rate else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())